@@ -1,6 +1,7 @@
-from machine import Pin
 import time
 import bluetooth
+from collections import deque
+from stepgen import StepGen
 
 SERVICE_UUID = bluetooth.UUID("19b10000-e8f2-537e-4f6c-d104768a1214")
 CHAR_UUID    = bluetooth.UUID("19b10002-e8f2-537e-4f6c-d104768a1214")
@@ -10,22 +11,36 @@ STEP_PIN_NUM = 32
 STEP_ANGLE_DEG = 1.8
 KEY_ANGLE_DEG  = 19.6
 MAX_OCTAVE     = 5
-PULSE_US       = 1000
+STEP_RATE_START = 300   # steps/s
+STEP_RATE_MAX   = 500    # the old fixed rate (1000 us half-period)
+STEP_ACCEL      = 5000    # steps/s^2
 
 NOTES = ("C","C#","D","D#","E","F","F#","G","G#","A","A#","B")
 
-dir_pin  = Pin(DIR_PIN_NUM, Pin.OUT, value=0)
-step_pin = Pin(STEP_PIN_NUM, Pin.OUT, value=0)
+stepper = StepGen(STEP_PIN_NUM, DIR_PIN_NUM, v_max=STEP_RATE_MAX, accel=STEP_ACCEL,
+                  v_start=STEP_RATE_START)
+pending = deque((), 16)     # moves received while one runs, started in order
+
+def on_done():
+    print("Rotation complete!")
+    if pending:
+        stepper.move(pending.popleft())
+
+stepper.on_done = on_done
 
 def rotate_step(angle_deg, clockwise=True):
+    # Runs from the BLE IRQ: start the pulse train and return, the RMT does the rest.
+    # Waiting here would also block the step generator's timer callback, so a
+    # command that arrives mid-move is queued and started from on_done().
     steps = int(angle_deg / STEP_ANGLE_DEG + 0.5)
-    dir_pin.value(1 if clockwise else 0)
     print(("Clockwise " if clockwise else "Counterclockwise ")
           + "{:.2f}° rotation ({} steps)".format(angle_deg, steps))
-    for _ in range(steps):
-        step_pin.value(1); time.sleep_us(PULSE_US)
-        step_pin.value(0); time.sleep_us(PULSE_US)
-    print("Rotation complete!")
+    if not clockwise:
+        steps = -steps
+    if stepper.busy():
+        pending.append(steps)
+        return
+    stepper.move(steps)
 
 def parse_note_with_octave(note_input):
     if not note_input:
@@ -1,7 +1,7 @@
-from machine import Pin
 import time
 import bluetooth
 from rotary_irq_esp import RotaryIRQ
+from stepgen import StepGen
 
 # ==========================================
 # 1. Configuration
@@ -15,35 +15,56 @@ DIR_PIN_NUM  = 33
 STEP_PIN_NUM = 32
 CLK_PIN      = 25   # Encoder CLK
 DT_PIN       = 26   # Encoder DT
+USE_PCNT     = True # Count encoder edges in the PCNT peripheral instead of pin IRQs (if the firmware has it)
 
 # --- Constants ---
 KEY_ANGLE_DEG  = 19.6   # Angle per key (degrees)
 MAX_OCTAVE     = 5
-PULSE_US       = 300   # Motor speed (larger = slower & more stable)
+STEP_ANGLE_DEG = 1.8    # Motor full step
+STEP_RATE_START = 600   # steps/s
+STEP_RATE_MAX   = 1667  # steps/s, the old fixed rate (300 us half-period)
+STEP_ACCEL      = 15000 # steps/s^2
 TOLERANCE_PCT  = 0.03   # Tolerance band 3% (0.03)
 
 # --- Encoder Settings ---
 STEPS_PER_REV_ENC = 600 # Encoder steps per revolution
+DEG_PER_COUNT     = 360 / STEPS_PER_REV_ENC
+# The encoder is read on the motor shaft: counts and steps are converted
+# through angle alone, with no gear ratio in between.
+# Moves re-plan themselves from the encoder before they start to brake (see
+# retarget_lead_counts); StepGen is kept to short chunks so that what it has
+# already committed (up to two chunks) leaves room to do so.
+RAMP_STEPS = (STEP_RATE_MAX ** 2 - STEP_RATE_START ** 2) / (2 * STEP_ACCEL)
+STEP_CHUNK = 8          # steps per RMT write
 
 NOTES = ("C","C#","D","D#","E","F","F#","G","G#","A","A#","B")
 
 # ==========================================
 # 2. Hardware Initialization
 # ==========================================
-dir_pin  = Pin(DIR_PIN_NUM, Pin.OUT, value=0)
-step_pin = Pin(STEP_PIN_NUM, Pin.OUT, value=0)
-
-# Initialize the encoder (if direction is reversed, change reverse=False)
-r = RotaryIRQ(pin_num_clk=CLK_PIN,
-              pin_num_dt=DT_PIN,
-              reverse=True,
-              incr=1,
-              range_mode=RotaryIRQ.RANGE_UNBOUNDED,
-              pull_up=True,
-              half_step=False)
+stepper = StepGen(STEP_PIN_NUM, DIR_PIN_NUM, v_max=STEP_RATE_MAX, accel=STEP_ACCEL,
+                  v_start=STEP_RATE_START, chunk_steps=STEP_CHUNK)
+
+# Initialize the encoder (if direction is reversed, change reverse=False;
+# check it again after switching USE_PCNT)
+Encoder = RotaryIRQ
+if USE_PCNT:
+    try:
+        from rotary_pcnt_esp import RotaryPCNT as Encoder
+    except ImportError:     # esp32.PCNT is MicroPython v1.25+
+        print("No esp32.PCNT in this firmware, counting encoder edges with pin IRQs")
+r = Encoder(pin_num_clk=CLK_PIN,
+            pin_num_dt=DT_PIN,
+            reverse=True,
+            incr=1,
+            range_mode=Encoder.RANGE_UNBOUNDED,
+            pull_up=True,
+            half_step=False)
 
 # Global variables
 target_angle = 0.0      # Target angle (absolute)
+target_count = 0        # Same target in encoder counts
+tolerance_counts = 0    # Arrival band in encoder counts
 is_active = False       # Whether motion is in progress
 
 # ==========================================
@@ -51,7 +72,19 @@ is_active = False       # Whether motion is in progress
 # ==========================================
 def get_current_angle():
     # Convert encoder count to degrees
-    return r.value() * (360 / STEPS_PER_REV_ENC)
+    return r.value() * DEG_PER_COUNT
+
+def retarget_lead_counts(steps):
+    # How far before the target a move of `steps` must re-plan: the ramp-down
+    # it will really use (half the move if it never reaches STEP_RATE_MAX),
+    # plus the chunks StepGen has committed.
+    lead = min(abs(steps) / 2, RAMP_STEPS) + 2 * STEP_CHUNK
+    return lead * STEP_ANGLE_DEG / DEG_PER_COUNT
+
+def replan():
+    # Encoder comparator callback (pin IRQ): set the steps still to go from
+    # the measured position, so the ramp-down ends on the target.
+    stepper.retarget(abs(target_count - r.value()) * DEG_PER_COUNT / STEP_ANGLE_DEG)
 
 def parse_note_with_octave(note_input):
     if not note_input: return -1
@@ -83,7 +116,7 @@ ble.active(True)
 ))
 
 def on_rx(v: bytes):
-    global target_angle, is_active
+    global target_angle, target_count, tolerance_counts, is_active
     try:
         cmd = v.decode("utf-8").strip()
         print(f"Received Command: {cmd}")
@@ -106,6 +139,11 @@ def on_rx(v: bytes):
             # Set absolute target angle based on current position
             current_ang = get_current_angle()
             target_angle = current_ang + move_angle
+            target_count = int(round(target_angle / DEG_PER_COUNT))
+
+            # Tolerance: 3% of target angle, or at least 1 degree
+            # (slack in case target is near 0). Computed once per job.
+            tolerance_counts = max(abs(target_angle) * TOLERANCE_PCT, 1.0) / DEG_PER_COUNT
 
             print(f"Job: Move {move_angle:.2f}°")
             print(f"Current: {current_ang:.2f}° -> Target: {target_angle:.2f}°")
@@ -143,35 +181,41 @@ print("System Ready. Waiting for command...")
 
 while True:
     if is_active:
-        # 1. Measure current state
-        current_deg = get_current_angle()
-        error = target_angle - current_deg
-
-        # 2. Compute tolerance (3% of target angle, or at least 1 degree)
-        # Give at least 1 degree slack in case target is near 0.
-        tolerance = max(abs(target_angle) * TOLERANCE_PCT, 1.0)
-
-        # 3. Check if target is reached
-        if abs(error) <= tolerance:
-            print(f"Reached! Cur: {current_deg:.2f}° / Tgt: {target_angle:.2f}° (Err: {error:.2f}°)")
-            is_active = False # Stop the motor
-
-        else:
-            # 4. Drive the motor (feedback)
-            # If target is larger (error > 0), rotate CW (1), else CCW (0)
-            # Depending on wiring, you may need to swap 1/0 or rewire.
-            direction = 1 if error > 0 else 0
-
-            dir_pin.value(direction)
-
-            # Move 1 step
-            step_pin.value(1)
-            time.sleep_us(PULSE_US)
-            step_pin.value(0)
-            time.sleep_us(PULSE_US)
-
-            # Debug (printing too often can slow down the loop; uncomment if needed)
-            # print(f"Move.. Cur: {current_deg:.1f} Tgt: {target_angle:.1f}")
+        # While a move runs the only thing to check is the completion flag:
+        # on long moves the encoder IRQ re-plans the rest of the move once,
+        # before the ramp-down starts.
+        if not stepper.busy():
+            # 1. Measure where the move (or the comparator) left us
+            error = target_count - r.value()
+
+            # 2. Check if target is reached
+            if abs(error) <= tolerance_counts:
+                r.disarm_target()
+                current_deg = get_current_angle()
+                print(f"Reached! Cur: {current_deg:.2f}° / Tgt: {target_angle:.2f}° (Err: {target_angle - current_deg:.2f}°)")
+                is_active = False # Stop the motor
+
+            else:
+                # 3. Drive the motor (feedback): send the whole error as one
+                # ramped move. If it is long enough, arm the comparator
+                # before its ramp-down starts to correct the rest of it from
+                # the encoder; the profile still decelerates into the target
+                # rather than being cut off at speed.
+                # Positive steps set DIR=1 (CW); depending on wiring, you may
+                # need dir_invert=True on the StepGen or rewire.
+                steps = int(error * DEG_PER_COUNT / STEP_ANGLE_DEG)
+                if steps == 0:
+                    steps = 1 if error > 0 else -1
+                lead = retarget_lead_counts(steps)
+                if abs(error) > lead:
+                    r.arm_target(int(target_count - (lead if error > 0 else -lead)), replan)
+                else:
+                    r.disarm_target()
+                stepper.move(steps)
+
+                # Debug (printing too often can slow down the loop; uncomment if needed)
+                # print(f"Move.. Cur: {get_current_angle():.1f} Tgt: {target_angle:.1f}")
+        time.sleep_ms(1)
 
     else:
         # Idle state (reduce CPU usage)
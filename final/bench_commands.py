@@ -0,0 +1,158 @@
+# Host benchmark for esp32_piano.handle_command (runs under CPython).
+#
+#   python bench_commands.py [firmware.py ...]
+#
+# machine, bluetooth, uasyncio and micropython are stubbed, and goto_idx /
+# press_chord are replaced by no-ops, so what is timed is the dispatch, the
+# argument parsing and building the response. The figures are for CPython on
+# this machine, not the ESP32. Give several copies of the firmware to compare
+# them, e.g.
+#   git show HEAD~1:final/esp32_piano.py > /tmp/old_piano.py
+#   python bench_commands.py /tmp/old_piano.py esp32_piano.py
+
+import asyncio
+import builtins
+import gc
+import os
+import sys
+import tempfile
+import time
+import types
+
+builtins.const = lambda x: x
+gc.mem_alloc = lambda: 0
+_t0 = time.monotonic()
+time.ticks_ms = lambda: int((time.monotonic() - _t0) * 1000)
+time.ticks_us = lambda: int((time.monotonic() - _t0) * 1000000)
+time.ticks_add = lambda a, b: a + b
+time.ticks_diff = lambda a, b: a - b
+time.sleep_ms = lambda ms: None
+time.sleep_us = lambda us: None
+
+
+class _Stub(object):
+    """Accepts any constructor / method call; reads return nothing."""
+
+    def __init__(self, *a, **k):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *a, **k: None
+
+    def any(self):
+        return 0
+
+    def readfrom_mem(self, addr, reg, n):
+        return bytes(n)
+
+    def gatts_register_services(self, services):
+        return ((1, 2),)
+
+
+machine = types.ModuleType("machine")
+machine.UART = machine.Pin = machine.I2C = _Stub
+sys.modules["machine"] = machine
+bluetooth = types.ModuleType("bluetooth")
+bluetooth.BLE = _Stub
+bluetooth.UUID = lambda s: s
+bluetooth.FLAG_READ, bluetooth.FLAG_WRITE, bluetooth.FLAG_NOTIFY = 2, 8, 16
+sys.modules["bluetooth"] = bluetooth
+micropython = types.ModuleType("micropython")
+micropython.native = lambda f: f
+micropython.schedule = lambda f, a: f(a)
+sys.modules["micropython"] = micropython
+
+
+class _ThreadSafeFlag(object):
+
+    def __init__(self):
+        self._e = asyncio.Event()
+
+    def set(self):
+        self._e.set()
+
+    async def wait(self):
+        await self._e.wait()
+        self._e.clear()
+
+
+async def _sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def _wait_for_ms(aw, ms):
+    return await asyncio.wait_for(aw, ms / 1000)
+
+
+uasyncio = types.ModuleType("uasyncio")
+uasyncio.__dict__.update(asyncio.__dict__)
+uasyncio.sleep_ms = _sleep_ms
+uasyncio.wait_for_ms = _wait_for_ms
+uasyncio.ThreadSafeFlag = _ThreadSafeFlag
+sys.modules["uasyncio"] = uasyncio
+
+# Commands in roughly the proportion a performance sends them: mostly PLAY.
+MIX = (["PLAY:12|1,3;0.5"] * 8 +
+       ["PLAY:-3|2;1.25", "CAL:SET_STEP:30.0", "STREAM:END", "CAL:TEST_SERVO:1:HOVER"])
+
+
+def load(path):
+    src = open(path).read()
+    src = src.replace('"/songs"', repr(tempfile.mkdtemp()))
+    src = src.replace("\nasyncio.run(main())", "\n").replace("\nstart()", "\n")
+    g = {"__name__": "piano"}
+    exec(compile(src, path, "exec"), g)
+    return g
+
+
+async def _nop(*a, **k):
+    pass
+
+
+async def run(handle, cmds, rounds):
+    t0 = time.process_time()
+    for _ in range(rounds):
+        for cmd in cmds:
+            await handle(cmd)
+    return time.process_time() - t0
+
+
+async def bench(handlers, rounds, repeat):
+    """Commands per CPU second for each handler, mixed and PLAY only. Runs
+    are interleaved and the best of `repeat` is kept, so background load on
+    the machine hits every build alike."""
+    play = ["PLAY:12|1,3;0.5"] * len(MIX)
+    best = [[None, None] for _ in handlers]
+    for _ in range(repeat):
+        for i, handle in enumerate(handlers):
+            for j, cmds in enumerate((MIX, play)):
+                dt = await run(handle, cmds, rounds)
+                if best[i][j] is None or dt < best[i][j]:
+                    best[i][j] = dt
+    n = rounds * len(MIX)
+    return [(n / a, n / b) for a, b in best]
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = sys.argv[1:] or [os.path.join(here, "esp32_piano.py")]
+    rounds, repeat = 2000, 7
+    handlers = []
+    for path in paths:
+        g = load(path)
+        g["goto_idx"] = _nop
+        g["press_chord"] = _nop
+        handle = g["handle_command"]
+        for cmd in MIX:
+            resp = asyncio.run(handle(cmd))
+            assert not str(resp).lstrip("b'").startswith("ERR"), (path, cmd, resp)
+        handlers.append(handle)
+    results = asyncio.run(bench(handlers, rounds, repeat))
+    print("%d commands per run, best of %d (commands per CPU second)" % (rounds * len(MIX), repeat))
+    print("  %-24s %10s %10s" % ("", "mixed", "PLAY only"))
+    for path, (mixed, play) in zip(paths, results):
+        print("  %-24s %10.0f %10.0f" % (os.path.basename(path), mixed, play))
+
+
+if __name__ == "__main__":
+    main()
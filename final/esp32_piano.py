@@ -3,12 +3,25 @@ ESP32 Piano Player - BLE Peripheral (v2)
 - Home = rightmost key (highest note)
 - step_degrees is SIGNED (direction embedded in sign)
 - Float absolute-angle tracking (no cumulative drift)
+- PLAY/EVENT binary frames to play, text commands to calibrate; songs can
+  also be stored under /songs and played from flash
+- uasyncio tasks for intake, motion and servo releases (see TASKS)
 """
 import bluetooth
 from machine import UART, Pin, I2C
+import gc
+import micropython
+import os
 import time
+import struct
+import uasyncio as asyncio
 from collections import deque
 
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
 # ============================================================
 # HARDWARE SETUP
 # ============================================================
@@ -16,7 +29,12 @@ uart = UART(2, baudrate=115200, tx=Pin(32), rx=Pin(33))
 ADDR = 0xE0
 MSTEP = 16
 PULSES_PER_REV = 3200
-SPEED_GEAR = 80
+SPEED_GEAR = 80         # Speed byte for moves without a deadline (calibration, jogs)
+SPEED_MIN = 20          # Slowest speed byte used when there is slack
+SPEED_MAX = 127         # Fastest allowed speed byte (7-bit field)
+ACC_GENTLE = 100        # Drive ACC parameter (0xA4) for moves at or below SPEED_GEAR
+ACC_FAST = 400          # ... and for moves that need more; tune both on the rig
+MOVE_BUDGET_FRAC = 0.8  # Plan to use this share of the time available for a move
 
 class PCA9685:
     def __init__(self, i2c, addr=0x40):
@@ -35,119 +53,913 @@ class PCA9685:
         data = bytearray([on & 0xFF, on >> 8, off & 0xFF, off >> 8])
         self.i2c.writeto_mem(self.addr, 0x06 + 4 * ch, data)
 
-i2c = I2C(0, scl=Pin(14), sda=Pin(13))
+class ServoBank:
+    """Shadow copy of the LEDn registers for PCA9685 channels lo..hi.
+    set() only stages a change (and drops it if the register already holds
+    that value); flush() writes every staged channel in one auto-increment
+    transaction, so the outputs of a chord all update on the same STOP.
+    burst=False writes one transaction per channel, for comparison."""
+    def __init__(self, pca, lo, hi):
+        self.pca = pca
+        self.lo = lo
+        self.n = hi - lo + 1
+        self.regs = bytearray(4 * self.n)   # ON_L, ON_H, OFF_L, OFF_H as last written
+        mv = memoryview(self.regs)
+        # Every contiguous span, sliced once so flush() allocates nothing.
+        self.spans = [[mv[4 * a:4 * (b + 1)] for b in range(self.n)] for a in range(self.n)]
+        self.known = 0          # bit i: regs hold what channel lo+i really has
+        self.dirty = 0
+        self.burst = True
+        self.skipped = 0        # set() calls that needed no write
+        self.i2c_us = 0         # last flush: time on the bus
+        self.i2c_max_us = 0
+        # Per-finger writes only: first to last channel updated. A burst is
+        # one transaction and the PCA9685 latches all outputs on its STOP
+        # (MODE2.OCH = 0), so there is no skew to measure; STATUS says 1TX.
+        self.skew_us = 0
+        self.skew_max_us = 0
+
+    def set(self, ch, off):
+        i = ch - self.lo
+        j = 4 * i
+        regs = self.regs
+        bit = 1 << i
+        if self.known & bit and regs[j + 2] == off & 0xFF and regs[j + 3] == off >> 8:
+            self.skipped += 1
+            return
+        regs[j] = 0
+        regs[j + 1] = 0
+        regs[j + 2] = off & 0xFF
+        regs[j + 3] = off >> 8
+        self.known |= bit
+        self.dirty |= bit
+
+    def flush(self):
+        dirty = self.dirty
+        if not dirty:
+            return
+        self.dirty = 0
+        lo = 0
+        while not dirty & (1 << lo):
+            lo += 1
+        hi = self.n - 1
+        while not dirty & (1 << hi):
+            hi -= 1
+        i2c, addr = self.pca.i2c, self.pca.addr
+        t0 = time.ticks_us()
+        if self.burst:
+            # Unchanged channels inside the span are rewritten with their
+            # current value, which is still cheaper than a second transaction.
+            i2c.writeto_mem(addr, 0x06 + 4 * (self.lo + lo), self.spans[lo][hi])
+            t_last = time.ticks_us()
+        else:
+            t1 = None
+            for i in range(lo, hi + 1):
+                if dirty & (1 << i):
+                    i2c.writeto_mem(addr, 0x06 + 4 * (self.lo + i), self.spans[i][i])
+                    t_last = time.ticks_us()
+                    if t1 is None:
+                        t1 = t_last
+            self.skew_us = time.ticks_diff(t_last, t1)
+            if self.skew_us > self.skew_max_us:
+                self.skew_max_us = self.skew_us
+        self.i2c_us = time.ticks_diff(t_last, t0)
+        if self.i2c_us > self.i2c_max_us:
+            self.i2c_max_us = self.i2c_us
+
+I2C_FREQ = 400000   # PCA9685 handles up to 1 MHz (Fm+); the ESP32 default is 100 kHz
+i2c = I2C(0, scl=Pin(14), sda=Pin(13), freq=I2C_FREQ)
 pca = PCA9685(i2c)
 pca.set_pwm_freq(50)
 
 SERVO_CH = [0, 1, 2, 3, 4]
+servos = ServoBank(pca, min(SERVO_CH), max(SERVO_CH))
 OPEN_PWM  = [90, 90, 90, 90, 90]
 CLOSE_PWM = [90, 90, 90, 90, 90]
+HOVER_PWM = [90, 90, 90, 90, 90]    # just above the key: re-strike lift and pre-strike position
+STRIKE_LAT_MS = [0, 0, 0, 0, 0]     # CLOSE command to key contact, from hover; CLOSE is sent this early
 
 # ============================================================
-# STEPPER STATE
+# STEPPER DRIVER (MKS SERVO42C/57C over UART)
 # ============================================================
-step_degrees = 30.0   # SIGNED. Sign = rotation direction per +1 index step.
-current_deg  = 0.0    # Absolute angle from home, float-accumulated.
+ENC_PER_REV   = 0x4000  # 14-bit magnetic encoder counts per revolution
+ENC_DIR       = 1       # -1 if the encoder counts down for CW pulses
+ARRIVE_COUNTS = 40      # |encoder - target| that counts as arrived (~0.9 deg)
+SETTLE_COUNTS = 4       # encoder change between polls that counts as stopped
+VERIFY_COUNTS = 45      # |encoder - commanded| that triggers a correction (~1 deg)
+MOVE_POLL_MS  = 5
+UART_TIMEOUT_MS = 20
+
+CMD_READ_ENCODER = 0x30
+CMD_SET_ACC      = 0xA4
+CMD_RUN_PULSES   = 0xFD
+STATUS_FAIL, STATUS_STARTED, STATUS_DONE = 0, 1, 2
 
 def calc_crc(data):
     return sum(data) & 0xFF
 
-def _send_move(degrees):
-    if abs(degrees) < 0.01:
-        return
-    pulses = int(round(abs(degrees) / 360.0 * PULSES_PER_REV))
-    if pulses == 0:
-        return
-    is_ccw = degrees < 0
-    speed_byte = (0x80 | SPEED_GEAR) if is_ccw else SPEED_GEAR
-    data = bytes([
-        ADDR, 0xFD, speed_byte,
-        (pulses >> 24) & 0xFF, (pulses >> 16) & 0xFF,
-        (pulses >> 8)  & 0xFF, pulses & 0xFF
-    ])
-    pkt = data + bytes([calc_crc(data)])
-    uart.write(pkt)
-    time.sleep_ms(5)
-    uart.read()
-    rpm = SPEED_GEAR * 30000 / (MSTEP * 200)
-    rotations = abs(degrees) / 360.0
-    wait_ms = int((rotations / rpm) * 60000 * 1.3) + 50
-    time.sleep_ms(wait_ms)
-
-def jog(degrees):
-    """Relative move that does NOT update current_deg (for homing)."""
-    _send_move(degrees)
-
-def goto_idx(key_idx):
-    """Absolute move. current_deg accumulates ideal target, so rounding self-corrects."""
+def estimate_move_ms(pulses, speed):
+    rpm = speed * 30000 / (MSTEP * 200)
+    rotations = abs(pulses) / PULSES_PER_REV
+    return int((rotations / rpm) * 60000)
+
+def pick_speed(pulses, budget_ms):
+    """Slowest speed byte that still lands inside budget_ms (0 = no deadline)."""
+    if budget_ms <= 0:
+        return SPEED_GEAR
+    # Move time is inversely proportional to the speed byte.
+    speed = int(estimate_move_ms(pulses, 1) / (budget_ms * MOVE_BUDGET_FRAC)) + 1
+    return max(SPEED_MIN, min(SPEED_MAX, speed))
+
+class MKSStepper:
+    """Relative-pulse moves (0xFD) whose end is taken from the drive itself:
+    the 'run complete' ack where the drive firmware sends one, otherwise the
+    encoder (0x30) settling on the expected count. With no encoder reply it
+    falls back to the old time estimate. The 42C command set has no
+    absolute-position move, so absolute targets are kept as integer drive
+    pulses here and sent as deltas."""
+    def __init__(self, uart, addr):
+        self.uart = uart
+        self.addr = addr
+        self.lock = asyncio.Lock()
+        self.tx = bytearray(8)
+        self.rx = bytearray(8)
+        self.rxv = memoryview(self.rx)
+        self.pos = 0            # commanded absolute position, drive pulses from home
+        self.enc_home = 0
+        self.enc_target = None  # expected encoder count at the end of the move
+        self.moving = False
+        self.deadline = 0
+        self.timeouts = 0
+        self.acc = None         # last ACC written to the drive
+        self.over_budget = 0    # moves that could not fit their deadline even at SPEED_MAX
+        self.homed = False      # enc_home is valid
+        self.moves = 0          # move_to() calls that moved
+        self.last_dir = 0
+        self.reversed = False   # a move changed direction since the last verify()
+        self.verifies = 0
+        self.corrections = 0
+        self.err_total = 0      # sum of |error| found by verify(), encoder counts
+
+    def _flush(self):
+        while self.uart.any():
+            self.uart.read()
+
+    async def _recv(self, start, end):
+        """Fill rx[start:end] from the UART. Returns the end offset reached."""
+        deadline = time.ticks_add(time.ticks_ms(), UART_TIMEOUT_MS)
+        while start < end:
+            if self.uart.any():
+                n = self.uart.readinto(self.rxv[start:end])
+                if n:
+                    start += n
+            elif time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                break
+            else:
+                await asyncio.sleep_ms(1)
+        return start
+
+    def _is_done_ack(self):
+        return self.rx[1] == STATUS_DONE and self.rx[2] == (self.addr + STATUS_DONE) & 0xFF
+
+    async def _read_encoder(self):
+        """Caller holds self.lock. Returns the encoder count or None."""
+        tx = self.tx
+        tx[0] = self.addr
+        tx[1] = CMD_READ_ENCODER
+        tx[2] = calc_crc(memoryview(tx)[:2])
+        self.uart.write(memoryview(tx)[:3])
+        if await self._recv(0, 3) < 3:
+            return None
+        if self._is_done_ack():
+            # 'run complete' arrived ahead of the reply
+            self.moving = False
+            if await self._recv(0, 3) < 3:
+                return None
+        if await self._recv(3, 8) < 8 or calc_crc(self.rxv[:7]) != self.rx[7]:
+            return None
+        carry, value = struct.unpack_from(">iH", self.rx, 1)
+        return carry * ENC_PER_REV + value
+
+    async def read_encoder(self):
+        async with self.lock:
+            return await self._read_encoder()
+
+    async def set_home(self):
+        await self.wait_done()
+        enc = await self.read_encoder()
+        self.enc_home = 0 if enc is None else enc
+        self.homed = enc is not None
+        self.pos = 0
+
+    async def position_deg(self):
+        """Angle from home as measured by the drive's encoder, or None."""
+        enc = await self.read_encoder()
+        if enc is None:
+            return None
+        return ENC_DIR * (enc - self.enc_home) * 360.0 / ENC_PER_REV
+
+    async def _set_acc(self, acc):
+        """Caller holds self.lock. Only written when it differs from the last
+        value sent; a missing reply does not make every later move resend
+        it, only an explicit refusal does."""
+        if acc == self.acc:
+            return
+        tx = self.tx
+        tx[0] = self.addr
+        tx[1] = CMD_SET_ACC
+        tx[2] = (acc >> 8) & 0xFF
+        tx[3] = acc & 0xFF
+        tx[4] = calc_crc(memoryview(tx)[:4])
+        self.uart.write(memoryview(tx)[:5])
+        self.acc = acc
+        if await self._recv(0, 3) == 3 and self.rx[1] != 1:
+            self.acc = None
+
+    async def move_by(self, pulses, speed=SPEED_GEAR, acc=ACC_GENTLE, target=None):
+        """Start a relative move; returns once the drive has accepted it.
+        target (move_to) is booked as self.pos once the packet is written:
+        cancelled before that, nothing moved and nothing is booked."""
+        await self.wait_done()      # never stack a second move onto a running one
+        if pulses == 0:
+            return
+        n = abs(pulses)
+        async with self.lock:
+            await self._set_acc(acc)
+            enc = await self._read_encoder()
+            self._flush()
+            tx = self.tx
+            tx[0] = self.addr
+            tx[1] = CMD_RUN_PULSES
+            tx[2] = (0x80 | speed) if pulses < 0 else speed
+            tx[3] = (n >> 24) & 0xFF
+            tx[4] = (n >> 16) & 0xFF
+            tx[5] = (n >> 8) & 0xFF
+            tx[6] = n & 0xFF
+            tx[7] = calc_crc(memoryview(tx)[:7])
+            self.uart.write(tx)
+            if target is not None:
+                self._book(target, pulses)
+            est = estimate_move_ms(n, speed)
+            self.moving = True
+            if enc is None:
+                self.enc_target = None
+                self.deadline = time.ticks_add(time.ticks_ms(), int(est * 1.3) + 50)
+            else:
+                self.enc_target = enc + ENC_DIR * pulses * ENC_PER_REV // PULSES_PER_REV
+                self.deadline = time.ticks_add(time.ticks_ms(), est * 2 + 100)
+            got = await self._recv(0, 3)
+        if got == 3 and self.rx[1] == STATUS_FAIL:
+            self.moving = False
+            if target is not None:
+                self.pos -= pulses
+            raise OSError("drive rejected move")
+
+    def _book(self, target, delta):
+        self.pos = target
+        self.moves += 1
+        d = 1 if delta > 0 else -1
+        if d != self.last_dir:
+            self.reversed = True
+            self.last_dir = d
+
+    async def move_to(self, target, budget_ms=0):
+        """Absolute move in drive pulses from home. budget_ms is the time until
+        the hand must be there; speed and acceleration are chosen to fit it."""
+        delta = target - self.pos
+        if delta == 0:
+            return
+        speed = pick_speed(delta, budget_ms)
+        if budget_ms > 0 and estimate_move_ms(delta, speed) > budget_ms:
+            self.over_budget += 1
+        await self.move_by(delta, speed, ACC_FAST if speed > SPEED_GEAR else ACC_GENTLE, target)
+
+    async def wait_done(self):
+        last = None
+        while self.moving:
+            timed_out = time.ticks_diff(time.ticks_ms(), self.deadline) >= 0
+            if self.enc_target is None:
+                if timed_out:
+                    self.moving = False
+                    break
+                async with self.lock:
+                    if self.uart.any() >= 3 and await self._recv(0, 3) == 3 and self._is_done_ack():
+                        self.moving = False
+                        break
+                await asyncio.sleep_ms(MOVE_POLL_MS)
+                continue
+            if timed_out:
+                self.timeouts += 1
+                self.moving = False
+                break
+            enc = await self.read_encoder()
+            if (enc is not None and last is not None
+                    and abs(enc - last) <= SETTLE_COUNTS
+                    and abs(enc - self.enc_target) <= ARRIVE_COUNTS):
+                self.moving = False
+                break
+            last = enc
+            await asyncio.sleep_ms(MOVE_POLL_MS)
+
+    def pulses_to_counts(self, pulses):
+        return ENC_DIR * pulses * ENC_PER_REV // PULSES_PER_REV
+
+    async def verify(self):
+        """Compare the encoder with the commanded position and move back onto
+        it if they disagree. Returns the error in encoder counts, or None if
+        the drive did not answer."""
+        await self.wait_done()
+        enc = await self.read_encoder()
+        if enc is None:
+            return None
+        self.reversed = False
+        if not self.homed:
+            # No SET_HOME yet: adopt the current reading as the reference.
+            self.enc_home = enc - self.pulses_to_counts(self.pos)
+            self.homed = True
+            return 0
+        self.verifies += 1
+        err = self.enc_home + self.pulses_to_counts(self.pos) - enc
+        self.err_total += abs(err)
+        if abs(err) > VERIFY_COUNTS:
+            self.corrections += 1
+            await self.move_by(int(round(ENC_DIR * err * PULSES_PER_REV / ENC_PER_REV)))
+            await self.wait_done()
+        return err
+
+stepper = MKSStepper(uart, ADDR)
+
+# ============================================================
+# STEPPER STATE
+# ============================================================
+step_degrees = 30.0   # SIGNED. Sign = rotation direction per +1 index step.
+current_deg  = 0.0    # Commanded angle from home; the drive holds it as integer pulses.
+
+# When goto_idx() checks the encoder (see MKSStepper.verify).
+VERIFY_OFF, VERIFY_ALWAYS, VERIFY_EVERY, VERIFY_REVERSE = 0, 1, 2, 3
+VERIFY_MODES = {"OFF": VERIFY_OFF, "ALWAYS": VERIFY_ALWAYS,
+                "EVERY": VERIFY_EVERY, "REVERSE": VERIFY_REVERSE}
+verify_mode  = VERIFY_REVERSE
+verify_every = 8      # moves between checks in VERIFY_EVERY mode
+verified_at  = 0      # stepper.moves at the last check
+
+def deg_to_pulses(deg):
+    return int(round(deg / 360.0 * PULSES_PER_REV))
+
+async def jog(degrees):
+    """Relative move that does NOT update current_deg (for homing). The
+    encoder reference moves with it so verify() does not undo the jog."""
+    pulses = deg_to_pulses(degrees)
+    await stepper.move_by(pulses)
+    await stepper.wait_done()
+    stepper.enc_home += stepper.pulses_to_counts(pulses)
+
+def verify_due():
+    if verify_mode == VERIFY_ALWAYS:
+        return stepper.moves != verified_at
+    if verify_mode == VERIFY_EVERY:
+        return stepper.moves - verified_at >= verify_every
+    if verify_mode == VERIFY_REVERSE:
+        return stepper.reversed
+    return False
+
+async def start_goto(key_idx, budget_ms=0):
+    """Absolute move that returns as soon as the driver has the command. A
+    move off the current key first waits for held fingers to release."""
     global current_deg
-    target_deg = key_idx * step_degrees
-    delta = target_deg - current_deg
-    _send_move(delta)
-    current_deg = target_deg
+    deg = key_idx * step_degrees
+    if deg != current_deg:
+        t0 = time.ticks_ms()
+        await wait_released()
+        if budget_ms:
+            budget_ms = max(1, budget_ms - time.ticks_diff(time.ticks_ms(), t0))
+    target = deg_to_pulses(deg)
+    try:
+        await stepper.move_to(target, budget_ms)
+    finally:
+        # Only once the drive has the packet (see move_by): an ABORT before
+        # that leaves both where the hand really is.
+        if stepper.pos == target:
+            current_deg = deg
+
+async def goto_idx(key_idx, budget_ms=0):
+    """Absolute move. The target is rounded from the ideal angle each time, so
+    rounding self-corrects. If a lookahead move to this key is already
+    running, this only waits for it."""
+    global verified_at
+    await start_goto(key_idx, budget_ms)
+    await stepper.wait_done()
+    if verify_due():
+        verified_at = stepper.moves
+        await stepper.verify()
 
-def press_chord(fingers, duration_s):
-    chs = []
+def fingers_to_mask(fingers):
+    mask = 0
     for f in fingers:
         if 1 <= f <= 5:
-            ch = f - 1
-            pca.set_pwm(SERVO_CH[ch], 0, CLOSE_PWM[ch])
-            chs.append(ch)
-    if chs:
-        time.sleep_ms(int(duration_s * 1000))
-        for ch in chs:
-            pca.set_pwm(SERVO_CH[ch], 0, OPEN_PWM[ch])
+            mask |= 1 << (f - 1)
+    return mask
 
 # ============================================================
-# COMMAND HANDLER
+# SERVOS
 # ============================================================
-def handle_command(cmd):
-    global step_degrees, current_deg
+# Fingers are closed by strike() and opened by per-channel release timers
+# serviced in servo_task(), so a hold never blocks anything but the caller.
+# strike() sends each CLOSE STRIKE_LAT_MS[ch] before the onset, slowest
+# finger first, and works out from the times the writes really went out
+# when each key was hit: chord_skew is the spread between the first and
+# last contact, chord_late how far the last one missed the onset (ms).
+MASK_RESTRIKE = 0x80        # event flag in the finger mask: same key and finger as the last event
+release_at = [None] * 5     # ticks_ms() at which each channel opens again
+hover_release = 0           # bit n: channel n lifts only to HOVER_PWM on its next release
+servo_wake = asyncio.Event()
+chord_skew = 0
+chord_skew_max = 0
+chord_late = 0
+chord_late_max = 0
+LAT_TEST_HOVER_MS = 500     # CAL:TEST_CHORD settle time at hover before the strike
+LAT_TEST_HOLD_MS = 300
+
+def chord_lead(mask):
+    """Longest strike latency among the fingers of mask (ms)."""
+    lead = 0
+    for ch in range(5):
+        if mask & (1 << ch) and STRIKE_LAT_MS[ch] > lead:
+            lead = STRIKE_LAT_MS[ch]
+    return lead
+
+async def strike(mask, onset, hold_ms, hover=0):
+    """Close the fingers of mask so they reach the keys at onset (ticks_ms)
+    and arm their release hold_ms after it. hover: channels of mask that will
+    re-strike next and so only lift to hover."""
+    global hover_release, chord_skew, chord_skew_max, chord_late, chord_late_max
+    sched = onset
+    # Too late for the slowest finger: move the whole chord back rather than
+    # let it spread out.
+    soonest = time.ticks_add(time.ticks_ms(), chord_lead(mask))
+    if time.ticks_diff(soonest, onset) > 0:
+        onset = soonest
+    due = time.ticks_add(onset, hold_ms)
+    hover_release = (hover_release & ~mask) | (hover & mask)
+    left = mask
+    first = last = None
+    while left:
+        # Fingers with the same latency share one burst.
+        lat = -1
+        for ch in range(5):
+            if left & (1 << ch) and STRIKE_LAT_MS[ch] > lat:
+                lat = STRIKE_LAT_MS[ch]
+        wait = time.ticks_diff(onset, time.ticks_ms()) - lat
+        if wait > 0:
+            await asyncio.sleep_ms(wait)
+        for ch in range(5):
+            if left & (1 << ch) and STRIKE_LAT_MS[ch] == lat:
+                servos.set(SERVO_CH[ch], CLOSE_PWM[ch])
+                release_at[ch] = due
+                left &= ~(1 << ch)
+        servos.flush()
+        servo_wake.set()
+        contact = time.ticks_diff(time.ticks_ms(), sched) + lat
+        if first is None or contact < first:
+            first = contact
+        if last is None or contact > last:
+            last = contact
+    chord_skew = last - first
+    chord_late = last
+    if chord_skew > chord_skew_max:
+        chord_skew_max = chord_skew
+    if chord_late > chord_late_max:
+        chord_late_max = chord_late
+
+def release(ch):
+    """Stage channel ch to open (or hover); the caller flushes."""
+    release_at[ch] = None
+    if hover_release & (1 << ch):
+        servos.set(SERVO_CH[ch], HOVER_PWM[ch])
+    else:
+        servos.set(SERVO_CH[ch], OPEN_PWM[ch])
+
+def hover(mask):
+    """Bring the fingers of an upcoming chord down to HOVER_PWM so the strike
+    at the onset is only the last short stroke. Fingers still holding a note
+    are left alone."""
+    for ch in range(5):
+        if mask & (1 << ch) and release_at[ch] is None:
+            servos.set(SERVO_CH[ch], HOVER_PWM[ch])
+    servos.flush()
+
+def release_all():
+    global hover_release
+    hover_release = 0
+    for ch in range(5):
+        release(ch)
+    servos.flush()
+
+def release_due():
+    """Open every channel whose timer has expired. Returns ms to the next
+    pending release, or -1 if none is armed."""
+    now = time.ticks_ms()
+    wait = -1
+    for ch in range(5):
+        due = release_at[ch]
+        if due is None:
+            continue
+        d = time.ticks_diff(due, now)
+        if d <= 0:
+            release(ch)
+        elif wait < 0 or d < wait:
+            wait = d
+    servos.flush()
+    return wait
+
+async def wait_released():
+    """Return once no finger is holding a key."""
+    while True:
+        wait = release_due()
+        if wait < 0:
+            return
+        await asyncio.sleep_ms(wait)
+
+async def servo_task():
+    while True:
+        servo_wake.clear()
+        wait = release_due()
+        try:
+            if wait < 0:
+                await servo_wake.wait()
+            else:
+                await asyncio.wait_for_ms(servo_wake.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+async def press_chord(mask, duration_ms, hover=0, onset=None):
+    """mask bit n = finger n+1 (channel n). onset: ticks_ms() the keys should
+    go down; None = as soon as the slowest finger can get there. Returns once
+    the keys are down; servo_task() releases them duration_ms later."""
+    mask &= 0x1F
+    if not mask:
+        return
+    if onset is None:
+        onset = time.ticks_add(time.ticks_ms(), chord_lead(mask))
+    await strike(mask, onset, duration_ms, hover)
+    wait = time.ticks_diff(onset, time.ticks_ms())
+    if wait > 0:
+        await asyncio.sleep_ms(wait)
+
+async def play_event(idx, mask, duration_ms, budget_ms=0, peek=None, onset=None):
+    """Move and strike; returns once the keys are down. budget_ms is the
+    travel time available before this onset. onset is the ticks_ms() of key
+    contact for timed events (see press_chord). peek() returns (key index,
+    budget_ms, mask) of the next queued event, or None. If the next event is
+    a re-strike on this key, its fingers lift only to HOVER_PWM. Fingers of a
+    chord hover during the move to it."""
+    hover(mask)
+    await goto_idx(idx, budget_ms)
+    lift = 0
+    if peek is not None:
+        nxt = peek()
+        if nxt is not None and nxt[0] == idx and nxt[2] & MASK_RESTRIKE:
+            lift = nxt[2]
+    await press_chord(mask, duration_ms, lift, onset)
+
+async def move_ahead(peek):
+    """Lookahead, run once the current event has been reported: start the
+    move to the next queued event (which waits for the fingers to release if
+    the hand has to leave the key) and bring its fingers to hover, instead of
+    waiting for the main loop to come round again."""
     try:
-        if cmd.startswith("CAL:JOG:"):
-            jog(float(cmd[8:]))
-            return "OK:JOG"
-        elif cmd == "CAL:SET_HOME":
-            current_deg = 0.0
-            return "OK:HOME"
-        elif cmd.startswith("CAL:SET_STEP:"):
-            step_degrees = float(cmd[13:])
-            return "OK:STEP=%.4f" % step_degrees
-        elif cmd.startswith("CAL:GOTO:"):
-            goto_idx(int(cmd[9:]))
-            return "OK:GOTO"
-        elif cmd.startswith("CAL:SET_SERVO:"):
-            parts = cmd[14:].split(":")
-            ch = int(parts[0])
-            if 0 <= ch <= 4:
-                OPEN_PWM[ch]  = int(parts[1])
-                CLOSE_PWM[ch] = int(parts[2])
-            return "OK:SERVO"
-        elif cmd.startswith("CAL:TEST_SERVO:"):
-            parts = cmd[15:].split(":")
-            ch = int(parts[0])
-            state = parts[1]
-            if 0 <= ch <= 4:
-                pwm = CLOSE_PWM[ch] if state == "CLOSE" else OPEN_PWM[ch]
-                pca.set_pwm(SERVO_CH[ch], 0, pwm)
-            return "OK:TEST"
-        elif cmd.startswith("PLAY:"):
-            body = cmd[5:]
-            move_part, play_part = body.split("|", 1)
-            idx = int(move_part)
-            fingers_str, dur_str = play_part.split(";", 1)
-            fingers = [int(x) for x in fingers_str.split(",") if x]
-            duration = float(dur_str)
-            goto_idx(idx)
-            press_chord(fingers, duration)
-            return "OK:PLAY"
-        elif cmd == "STATUS":
-            return "OK:POS=%.3f,STEP=%.4f" % (current_deg, step_degrees)
+        nxt = peek()
+        if nxt is not None:
+            await start_goto(nxt[0], nxt[1])
+            hover(nxt[2])
+    except Exception:
+        pass    # the event's own goto_idx() retries and reports it
+
+# ============================================================
+# COMMAND HANDLER
+# ============================================================
+# Commands that move hardware run in order on the motion task; everything
+# else is answered straight from the intake task, even mid-move.
+#
+# A command is "<opcode>:<argument>". The opcode is the first field, or the
+# first two for the CAL: and STREAM: groups, and selects the handler from
+# COMMANDS in one dict lookup. Handlers take the argument string and return
+# the response; fixed responses are prebuilt bytes.
+OK_JOG    = b"OK:JOG"
+OK_HOME   = b"OK:HOME"
+OK_GOTO   = b"OK:GOTO"
+OK_SERVO  = b"OK:SERVO"
+OK_TEST   = b"OK:TEST"
+OK_PLAY   = b"OK:PLAY"
+OK_STREAM = b"OK:STREAM"
+OK_START  = b"OK:START"
+OK_END    = b"OK:END"
+OK_ABORT  = b"OK:ABORT"
+ERR_UNKNOWN = b"ERR:UNKNOWN"
+ERR_VERIFY_MODE = b"ERR:VERIFY_MODE"
+ERR_PLAY  = b"ERR:PLAY"
+
+def split_op(cmd):
+    """'CAL:JOG:5' -> ('CAL:JOG', '5'), 'PLAY:3|1;0.5' -> ('PLAY', '3|1;0.5'),
+    'STATUS' -> ('STATUS', '')."""
+    i = cmd.find(":")
+    if (i == 3 and cmd.startswith("CAL")) or (i == 6 and cmd.startswith("STREAM")):
+        i = cmd.find(":", i + 1)
+    if i < 0:
+        return cmd, ""
+    return cmd[:i], cmd[i + 1:]
+
+play_args = [0, 0, 0]   # idx, finger mask, duration_ms; filled by parse_play()
+
+def parse_play(s, out):
+    """'<idx>|<finger>,<finger>...;<seconds>' -> out[0..2] = idx, finger mask,
+    duration in ms. One pass over the characters, no intermediate strings or
+    floats. Returns False if the text is malformed."""
+    field = 0       # 0 = idx, 1 = fingers, 2 = seconds
+    sign = 1
+    v = 0
+    mask = 0
+    dot = False
+    scale = 100     # ms per digit after the decimal point
+    for c in s:
+        d = ord(c) - 48
+        if 0 <= d <= 9:
+            if not dot:
+                v = v * 10 + d
+            elif scale:
+                v += d * scale
+                scale //= 10
+        elif (c == "," or c == ";") and field == 1:
+            if 1 <= v <= 5:
+                mask |= 1 << (v - 1)
+            v = 0
+            if c == ";":
+                field = 2
+        elif c == "|" and field == 0:
+            out[0] = sign * v
+            v = 0
+            field = 1
+        elif c == "-" and field == 0 and v == 0:
+            sign = -1
+        elif c == "." and field == 2 and not dot:
+            v *= 1000
+            dot = True
+        elif c != " ":
+            return False
+    if field != 2:
+        return False
+    out[1] = mask
+    out[2] = v if dot else v * 1000
+    return True
+
+async def cmd_play(arg):
+    if not parse_play(arg, play_args):
+        return ERR_PLAY
+    await goto_idx(play_args[0])
+    await press_chord(play_args[1], play_args[2])
+    return OK_PLAY
+
+async def cmd_jog(arg):
+    await jog(float(arg))
+    return OK_JOG
+
+async def cmd_set_home(arg):
+    global current_deg
+    current_deg = 0.0
+    await stepper.set_home()
+    return OK_HOME
+
+async def cmd_set_step(arg):
+    global step_degrees
+    step_degrees = float(arg)
+    return "OK:STEP=%.4f" % step_degrees
+
+async def cmd_goto(arg):
+    await goto_idx(int(arg))
+    return OK_GOTO
+
+async def cmd_verify(arg):
+    # CAL:VERIFY:OFF|ALWAYS|REVERSE|EVERY[:n]
+    global verify_mode, verify_every
+    parts = arg.split(":")
+    if parts[0] not in VERIFY_MODES:
+        return ERR_VERIFY_MODE
+    verify_mode = VERIFY_MODES[parts[0]]
+    if len(parts) > 1:
+        verify_every = max(1, int(parts[1]))
+    return "OK:VERIFY=%s" % arg
+
+async def cmd_servo_burst(arg):
+    # 0 = one I2C write per finger (the old behaviour), to compare timings
+    servos.burst = arg != "0"
+    servos.i2c_max_us = servos.skew_us = servos.skew_max_us = 0
+    return "OK:BURST=%d" % servos.burst
+
+async def cmd_set_servo(arg):
+    # CAL:SET_SERVO:<ch>:<open>:<close>[:<hover>]; hover defaults to halfway
+    parts = arg.split(":")
+    ch = int(parts[0])
+    if 0 <= ch <= 4:
+        OPEN_PWM[ch]  = int(parts[1])
+        CLOSE_PWM[ch] = int(parts[2])
+        if len(parts) > 3:
+            HOVER_PWM[ch] = int(parts[3])
         else:
-            return "ERR:UNKNOWN"
+            HOVER_PWM[ch] = (OPEN_PWM[ch] + CLOSE_PWM[ch]) // 2
+    return OK_SERVO
+
+async def cmd_set_lat(arg):
+    # CAL:SET_LAT:<ch>:<ms> - CLOSE-to-contact time of one finger, from hover
+    global chord_skew_max, chord_late_max
+    parts = arg.split(":")
+    ch = int(parts[0])
+    if 0 <= ch <= 4:
+        STRIKE_LAT_MS[ch] = max(0, int(parts[1]))
+    chord_skew_max = chord_late_max = 0
+    return "OK:LAT=" + ",".join(str(x) for x in STRIKE_LAT_MS)
+
+async def cmd_test_chord(arg):
+    # CAL:TEST_CHORD:<mask> - hover, then strike with latency compensation
+    mask = int(arg) & 0x1F
+    hover(mask)
+    await asyncio.sleep_ms(LAT_TEST_HOVER_MS)
+    await press_chord(mask, LAT_TEST_HOLD_MS)
+    await wait_released()
+    hover(mask)
+    return "OK:CHORD:SKEW=%d,LATE=%d" % (chord_skew, chord_late)
+
+async def cmd_test_servo(arg):
+    parts = arg.split(":")
+    ch = int(parts[0])
+    state = parts[1]
+    if 0 <= ch <= 4:
+        if state == "CLOSE":
+            pwm = CLOSE_PWM[ch]
+        elif state == "HOVER":
+            pwm = HOVER_PWM[ch]
+        else:
+            pwm = OPEN_PWM[ch]
+        servos.set(SERVO_CH[ch], pwm)
+        servos.flush()
+    return OK_TEST
+
+async def cmd_song(arg):
+    return handle_song_command(arg)
+
+async def cmd_stream_reset(arg):
+    stream_reset()
+    return OK_STREAM
+
+async def cmd_stream_start(arg):
+    stream_begin(int(arg))
+    return OK_START
+
+async def cmd_stream_end(arg):
+    stream_finish()
+    return OK_END
+
+async def cmd_abort(arg):
+    abort()
+    return OK_ABORT
+
+async def cmd_status(arg):
+    enc_deg = await stepper.position_deg()
+    return ("OK:POS=%.3f,ENC=%s,STEP=%.4f,Q=%d,OVF=%d,UR=%d,MTO=%d,OVB=%d,"
+            "VER=%d,COR=%d,CERR=%.2f,I2C=%d/%d,SKEW=%s,CSKEW=%d/%d,CLATE=%d/%d,"
+            "RXD=%d,LONG=%d,RXA=%d/%d,SLATE=%d/%d/%d,EXEC=%s,OUTD=%d") % (
+        current_deg, "-" if enc_deg is None else "%.2f" % enc_deg, step_degrees,
+        ble.backlog(), ble.overflows, underruns, stepper.timeouts, stepper.over_budget,
+        stepper.verifies, stepper.corrections, stepper.err_total * 360.0 / ENC_PER_REV,
+        servos.i2c_us, servos.i2c_max_us,
+        "1TX" if servos.burst else "%d/%d" % (servos.skew_us, servos.skew_max_us),
+        chord_skew, chord_skew_max, chord_late, chord_late_max,
+        ble.rx_dropped, ble.long_lines, ble.rx_alloc, ble.rx_alloc_max,
+        start_late, start_late_max, start_late_sum // max(1, start_count),
+        "THREAD" if ble.threaded else "ASYNC", ble.out_dropped)
+
+async def cmd_mem(arg):
+    # MEM[:RESET] - heap and GC figures; MAXBLK is the largest free block at
+    # motion_task()'s last idle probe ("-" if it has not had one yet)
+    global maxblk_req
+    if arg == "RESET":
+        gc_stats_reset()
+    if not perf_on:
+        maxblk_done.clear()
+        maxblk_req = True
+        motion_wake.set()
+        try:
+            await asyncio.wait_for_ms(maxblk_done.wait(), MAXBLK_WAIT_MS)
+        except asyncio.TimeoutError:
+            pass
+    return "OK:MEM:FREE=%d,ALLOC=%d,MAXBLK=%s,GC=%d,AUTO=%d,GCUS=%d/%d/%d,PERF=%s" % (
+        gc.mem_free(), gc.mem_alloc(), "-" if maxblk < 0 else "%d" % maxblk,
+        gc_count, gc_auto, gc_us, gc_us_max, gc_us_sum // max(1, gc_count),
+        "ON" if perf_on else "ARMED" if perf_mode else "OFF")
+
+async def cmd_perf(arg):
+    # CAL:PERF:ON|OFF - performance mode during playback (see MEMORY)
+    global perf_mode
+    perf_mode = arg == "ON"
+    return "OK:PERF=%s" % ("ON" if perf_mode else "OFF")
+
+COMMANDS = {
+    "PLAY":            cmd_play,
+    "CAL:JOG":         cmd_jog,
+    "CAL:SET_HOME":    cmd_set_home,
+    "CAL:SET_STEP":    cmd_set_step,
+    "CAL:GOTO":        cmd_goto,
+    "CAL:VERIFY":      cmd_verify,
+    "CAL:SERVO_BURST": cmd_servo_burst,
+    "CAL:SET_SERVO":   cmd_set_servo,
+    "CAL:SET_LAT":     cmd_set_lat,
+    "CAL:TEST_CHORD":  cmd_test_chord,
+    "CAL:TEST_SERVO":  cmd_test_servo,
+    "CAL:PERF":        cmd_perf,
+    "SONG":            cmd_song,
+    "STREAM:RESET":    cmd_stream_reset,
+    "STREAM:START":    cmd_stream_start,
+    "STREAM:END":      cmd_stream_end,
+    "ABORT":           cmd_abort,
+    "STATUS":          cmd_status,
+    "MEM":             cmd_mem,
+}
+MOTION_OPS = ("PLAY", "CAL:JOG", "CAL:GOTO", "CAL:TEST_CHORD")
+
+def is_motion_command(cmd):
+    return split_op(cmd)[0] in MOTION_OPS
+
+async def handle_command(cmd):
+    op, arg = split_op(cmd)
+    handler = COMMANDS.get(op)
+    if handler is None:
+        return ERR_UNKNOWN
+    try:
+        return await handler(arg)
     except Exception as e:
         return "ERR:%s" % str(e)
 
+# ============================================================
+# BINARY FRAMES
+# ============================================================
+# PLAY frame: opcode, seq, int16 idx, finger mask, uint16 duration_ms,
+# uint16 travel budget_ms (0 = no deadline), crc.
+# Opcodes have the high bit set, so a frame can never be mistaken for a text line.
+OP_PLAY   = 0xA1
+OP_EVENT  = 0xA2
+OP_DATA   = 0xA3    # opcode, seq, raw payload bytes, crc (song upload)
+OP_ACK    = 0xB1
+FRAME_FMT = "<BBhBHH"
+FRAME_LEN = struct.calcsize(FRAME_FMT) + 1
+# EVENT frame: PLAY fields + uint32 onset in ms after the agreed stream start.
+EVENT_FMT = "<BBhBHHI"
+EVENT_LEN = struct.calcsize(EVENT_FMT) + 1
+# ACK notification: OP_ACK, seq, result code, free queue slots, last accepted seq,
+# int16 ms the keys went down after the onset (0 for PLAY), underrun count (mod 256).
+# Free slots + last accepted seq let the conductor compute exact credits.
+ACK_FMT   = "<BBBBBhB"
+ACK_LEN   = struct.calcsize(ACK_FMT)
+ACK_OK, ACK_ERR, ACK_BAD_CRC, ACK_OVERFLOW = 0, 1, 2, 3
+
+# Little-endian field readers for the per-event paths: struct.unpack_from()
+# builds a new tuple every call, these fill preallocated lists instead.
+def u16(b, i):
+    return b[i] | b[i + 1] << 8
+
+def s16(b, i):
+    v = b[i] | b[i + 1] << 8
+    return v - 0x10000 if v & 0x8000 else v
+
+def u32(b, i):
+    return b[i] | b[i + 1] << 8 | b[i + 2] << 16 | b[i + 3] << 24
+
+def unpack_event(b, ev):
+    """EVENT_FMT, decoded into the 7-slot list ev."""
+    ev[0] = b[0]
+    ev[1] = b[1]
+    ev[2] = s16(b, 2)
+    ev[3] = b[4]
+    ev[4] = u16(b, 5)
+    ev[5] = u16(b, 7)
+    ev[6] = u32(b, 9)
+    return ev
+
+async def handle_frame(frame, peek=None):
+    """frame = (op, seq, idx, mask, dur_ms, budget_ms[, t_ms]) as unpacked in
+    ble_irq (a pooled list for EVENT frames). Returns an ACK code."""
+    try:
+        if frame[0] == OP_PLAY:
+            await play_event(frame[2], frame[3], frame[4], frame[5], peek)
+            return ACK_OK
+        if frame[0] == OP_EVENT:
+            onset = None if stream_start is None else time.ticks_add(stream_start, frame[6])
+            await play_event(frame[2], frame[3], frame[4], frame[5], peek, onset)
+            return ACK_OK
+        if frame[0] == OP_DATA:
+            return ACK_OK if song_write(frame[2]) else ACK_ERR
+        return ACK_ERR
+    except Exception:
+        return ACK_ERR
+
 # ============================================================
 # BLE PERIPHERAL
 # ============================================================
@@ -162,26 +974,194 @@ SERVICES = (
     )),
 )
 
+BLE_MTU = 247                # Preferred ATT MTU; the central starts the exchange
+RX_BUF_LEN = BLE_MTU - 3     # Largest single write accepted on RX
+QUEUE_LEN = 32
+EVT_BUF_LEN = 64             # Jitter buffer for timestamped EVENT frames
+RX_RING_LEN = 512            # Text reassembly ring; must be a power of two
+RX_MASK = RX_RING_LEN - 1
+RX_LINE_MAX = 128            # Longer text lines are dropped (and counted)
+RX_BROKEN = 0xFF             # Never in UTF-8: marks a line that lost a write (see rx_reject)
+OUTBOX_LEN = 32              # Notifications queued for the front-end in threaded mode
+# Decoded EVENT frames live in a fixed pool, reused in turn. At most
+# EVT_BUF_LEN are buffered, plus next_event and the one running.
+EVT_POOL_LEN = EVT_BUF_LEN + 2
+
+ble = None
+
 class BLEPeripheral:
-    def __init__(self):
+    """threaded=True: the executor runs on another _thread. Commands and
+    events cross over through queue/events under self.lock, and every
+    notification is queued in outbox, with flush_outbox() scheduled onto
+    the main thread to send it."""
+    def __init__(self, threaded=False):
         self.ble = bluetooth.BLE()
         self.ble.active(True)
+        self.ble.config(mtu=BLE_MTU)
         self.ble.irq(self.ble_irq)
         ((self.rx_handle, self.tx_handle,),) = self.ble.gatts_register_services(SERVICES)
-        self.buffer = b""
-        self.queue = deque((), 32)
+        # Default characteristic buffer is 20 bytes; allow a full MTU-sized write.
+        self.ble.gatts_set_buffer(self.rx_handle, RX_BUF_LEN)
+        # Text reassembly: ble_irq only copies bytes in at rx_head; rx_lines()
+        # scans from rx_scan for newlines and cuts lines from rx_tail.
+        self.ring = bytearray(RX_RING_LEN)
+        self.rx_head = 0
+        self.rx_scan = 0
+        self.rx_tail = 0
+        self.rx_skip = False        # discarding up to the next newline
+        self.rx_pending = False     # rx_lines() already scheduled
+        self.rx_lines_cb = self.rx_lines    # bound once; schedule() would allocate one per call
+        self.line = bytearray(RX_LINE_MAX)
+        self.line_mv = memoryview(self.line)
+        self.rx_dropped = 0         # text writes lost to a full ring
+        self.long_lines = 0         # lines over RX_LINE_MAX
+        self.rx_alloc = 0           # heap bytes allocated receiving the last text line
+        self.rx_alloc_max = 0
+        self.rx_alloc_acc = 0
+        self.queue = deque((), QUEUE_LEN)
+        self.events = deque((), EVT_BUF_LEN)
+        self.ev_pool = [[0] * 7 for _ in range(EVT_POOL_LEN)]
+        self.ev_next = 0
         self.conn_handle = None
+        self.mtu = 23
+        self.ack = bytearray(ACK_LEN)
+        self.rx_seq = 0
+        self.overflows = 0
+        self.rx_flag = asyncio.ThreadSafeFlag()    # set from ble_irq when queue/events grow
+        self.threaded = threaded
+        self.lock = _thread.allocate_lock() if threaded else None
+        self.outbox = deque((), OUTBOX_LEN)
+        self.out_dropped = 0        # notifications lost to a full outbox
+        self.tx_pending = False     # flush_outbox() already scheduled
+        self.flush_cb = self.flush_outbox
+        # Threaded mode: each queued ACK needs its own buffer until it is
+        # sent. Acks leave the outbox in order, so with one slot more than
+        # the outbox holds, the next slot is never queued or being sent.
+        self.ack_pool = [bytearray(ACK_LEN) for _ in range(OUTBOX_LEN + 1)] if threaded else None
+        self.ack_next = 0
         self.advertise()
         self.set_status("READY")
 
+    def backlog(self):
+        """Commands received but not yet finished executing."""
+        return len(self.queue) + len(jobs) + (lookahead is not None)
+
+    def put(self, q, item):
+        if self.lock is None:
+            q.append(item)
+            return
+        with self.lock:
+            q.append(item)
+
+    def take(self, q):
+        """Oldest item of q, or None if it is empty."""
+        if self.lock is None:
+            return q.popleft() if q else None
+        with self.lock:
+            return q.popleft() if q else None
+
     def set_status(self, status):
-        self.ble.gatts_write(self.tx_handle, status.encode('utf-8'))
+        """status: str, or bytes for the prebuilt responses."""
+        if isinstance(status, str):
+            status = status.encode('utf-8')
+        if self.threaded:
+            with self.lock:
+                if len(self.outbox) >= OUTBOX_LEN:
+                    self.out_dropped += 1
+                    return
+                self.outbox.append(status)
+            self.wake_front()
+            return
+        self.notify_status(status)
+
+    def notify_status(self, status):
+        self.ble.gatts_write(self.tx_handle, status)
         if self.conn_handle is not None:
             try:
                 self.ble.gatts_notify(self.conn_handle, self.tx_handle)
             except:
                 pass
 
+    def send_ack(self, seq, code, free, late_ms=0):
+        if self.conn_handle is None:
+            return
+        if not self.threaded:
+            struct.pack_into(ACK_FMT, self.ack, 0, OP_ACK, seq, code, free, self.rx_seq,
+                             min(late_ms, 32767), underruns & 0xFF)
+            self.notify_ack(self.ack)
+            return
+        # BLE callbacks (on_frame) and the executor both get here: pick the
+        # slot, pack and queue under the one lock.
+        with self.lock:
+            if len(self.outbox) >= OUTBOX_LEN:
+                self.out_dropped += 1
+                return
+            ack = self.ack_pool[self.ack_next]
+            self.ack_next = (self.ack_next + 1) % (OUTBOX_LEN + 1)
+            struct.pack_into(ACK_FMT, ack, 0, OP_ACK, seq, code, free, self.rx_seq,
+                             min(late_ms, 32767), underruns & 0xFF)
+            self.outbox.append(ack)
+        self.wake_front()
+
+    def notify_ack(self, ack):
+        try:
+            self.ble.gatts_notify(self.conn_handle, self.tx_handle, ack)
+        except:
+            pass
+
+    def wake_front(self):
+        """Have flush_outbox() run on the main thread, which is where
+        schedule() callbacks run (and on the ESP32 it wakes the main task
+        out of its sleep at once)."""
+        if not self.tx_pending:
+            self.tx_pending = True
+            try:
+                micropython.schedule(self.flush_cb, None)
+            except RuntimeError:
+                self.tx_pending = False     # schedule queue full; front_end() catches up
+
+    def flush_outbox(self, _=None):
+        """Front-end side of threaded mode: send what the executor queued.
+        ACKs are the bytearrays from ack_pool, statuses are bytes."""
+        self.tx_pending = False
+        while self.outbox:
+            data = self.take(self.outbox)
+            if not isinstance(data, bytearray):
+                self.notify_status(data)
+            elif self.conn_handle is not None:
+                self.notify_ack(data)
+
+    def on_frame(self, chunk):
+        n = len(chunk)
+        op, seq = chunk[0], chunk[1]
+        if op == OP_EVENT and n == EVENT_LEN:
+            q, cap, fmt = self.events, EVT_BUF_LEN, EVENT_FMT
+        elif op == OP_PLAY and n == FRAME_LEN:
+            q, cap, fmt = self.queue, QUEUE_LEN, FRAME_FMT
+        elif op == OP_DATA and n > 3:
+            q, cap, fmt = self.queue, QUEUE_LEN, None
+        else:
+            self.send_ack(seq, ACK_ERR, QUEUE_LEN - self.backlog())
+            return
+        used = len(q) if q is self.events else self.backlog()
+        # calc_crc over all but the last byte, without slicing.
+        if (sum(chunk) - chunk[n - 1]) & 0xFF != chunk[n - 1]:
+            self.send_ack(seq, ACK_BAD_CRC, cap - used)
+        elif used >= cap:
+            # deque would silently drop it; tell the conductor instead.
+            self.overflows += 1
+            self.send_ack(seq, ACK_OVERFLOW, 0)
+        else:
+            self.rx_seq = seq
+            if fmt is None:
+                self.put(q, (op, seq, bytes(chunk[2:n - 1])))
+            elif q is self.events:
+                self.put(q, unpack_event(chunk, self.ev_pool[self.ev_next]))
+                self.ev_next = (self.ev_next + 1) % EVT_POOL_LEN
+            else:
+                self.put(q, struct.unpack_from(fmt, chunk))
+            self.rx_flag.set()
+
     def advertise(self):
         name = bytes(BLE_NAME, 'utf-8')
         adv_data = bytearray(b'\x02\x01\x06') + bytearray([len(name) + 1, 0x09]) + name
@@ -194,40 +1174,610 @@ class BLEPeripheral:
         elif event == 2:
             self.conn_handle = None
             self.advertise()
+        elif event == 21:   # _IRQ_MTU_EXCHANGED
+            _, self.mtu = data
         elif event == 3:
             _, attr_handle = data
             if attr_handle == self.rx_handle:
+                a0 = gc.mem_alloc()
                 chunk = self.ble.gatts_read(self.rx_handle)
-                # MicroPython bytearray doesn't support slice deletion,
-                # so we use a plain bytes buffer and rebuild it.
-                self.buffer = self.buffer + bytes(chunk)
-                while True:
-                    idx = self.buffer.find(b'\n')
-                    if idx < 0:
-                        break
+                if chunk and chunk[0] & 0x80:
+                    # Binary frames always arrive in a single write.
+                    self.on_frame(chunk)
+                    return
+                n = len(chunk)
+                # One byte is kept spare for rx_reject()'s marker.
+                if ((self.rx_head - self.rx_tail) & RX_MASK) + n >= RX_RING_LEN - 1:
+                    self.rx_dropped += 1
+                    self.rx_reject(chunk[n - 1] == 10)
+                else:
+                    self.rx_copy(chunk, n)
+                self.rx_alloc_acc += gc.mem_alloc() - a0
+                if not self.rx_pending:
+                    self.rx_pending = True
                     try:
-                        msg = self.buffer[:idx].decode('utf-8').strip()
-                    except:
-                        msg = ""
-                    self.buffer = self.buffer[idx+1:]
-                    if msg:
-                        self.queue.append(msg)
-
-def main():
-    ble = BLEPeripheral()
-    for ch in range(5):
-        pca.set_pwm(SERVO_CH[ch], 0, OPEN_PWM[ch])
-    print("ESP32 Piano v2 ready. Home = rightmost key.")
+                        micropython.schedule(self.rx_lines_cb, None)
+                    except RuntimeError:
+                        self.rx_pending = False     # schedule queue full; the next write retries
+
+    @micropython.native
+    def rx_copy(self, chunk, n):
+        ring = self.ring
+        h = self.rx_head
+        for i in range(n):
+            ring[h] = chunk[i]
+            h = (h + 1) & RX_MASK
+        self.rx_head = h
+
+    def rx_reject(self, ends_line):
+        """A write did not fit and is lost, and with it the line it belongs
+        to; complete lines already in the ring are kept. Whatever of that
+        line is in the ring is cut off, and unless the write ended the line,
+        a RX_BROKEN byte goes in its place so rx_line() drops the rest of it
+        when it arrives."""
+        ring = self.ring
+        tail = self.rx_tail
+        h = self.rx_head
+        while h != tail and ring[(h - 1) & RX_MASK] != 10:
+            h = (h - 1) & RX_MASK
+        if ((self.rx_scan - tail) & RX_MASK) > ((h - tail) & RX_MASK):
+            self.rx_scan = h
+        if not ends_line:
+            ring[h] = RX_BROKEN
+            h = (h + 1) & RX_MASK
+        self.rx_head = h
+
+    def rx_lines(self, _):
+        """Scheduled from ble_irq: look at the bytes that arrived since the
+        last call and queue every complete line."""
+        self.rx_pending = False
+        a0 = gc.mem_alloc()
+        ring = self.ring
+        head = self.rx_head
+        i = self.rx_scan
+        while i != head:
+            if ring[i] == 10:
+                if self.rx_skip:
+                    self.rx_skip = False
+                else:
+                    self.rx_line(self.rx_tail, i)
+                    a1 = gc.mem_alloc()
+                    # A GC in between makes the difference meaningless.
+                    self.rx_alloc = max(0, self.rx_alloc_acc + a1 - a0)
+                    if self.rx_alloc > self.rx_alloc_max:
+                        self.rx_alloc_max = self.rx_alloc
+                    self.rx_alloc_acc = 0
+                    a0 = a1
+                self.rx_tail = (i + 1) & RX_MASK
+            elif not self.rx_skip and ((i - self.rx_tail) & RX_MASK) >= RX_LINE_MAX:
+                self.long_lines += 1
+                self.rx_skip = True
+            i = (i + 1) & RX_MASK
+        self.rx_scan = i
+        if self.rx_skip:
+            self.rx_tail = i
+
+    def rx_line(self, start, end):
+        """Queue ring[start:end] (wrapping) as a command string. Surrounding
+        whitespace is trimmed while copying, like str.strip()."""
+        ring = self.ring
+        if start != end and ring[start] == RX_BROKEN:
+            return
+        while start != end and ring[start] <= 32:
+            start = (start + 1) & RX_MASK
+        while end != start and ring[(end - 1) & RX_MASK] <= 32:
+            end = (end - 1) & RX_MASK
+        line = self.line
+        n = 0
+        while start != end:
+            line[n] = ring[start]
+            n += 1
+            start = (start + 1) & RX_MASK
+        if not n:
+            return
+        try:
+            msg = str(self.line_mv[:n], 'utf-8')
+        except:
+            return
+        if self.backlog() >= QUEUE_LEN:
+            self.overflows += 1
+            self.set_status("ERR:OVERFLOW")
+        else:
+            self.put(self.queue, msg)
+            self.rx_flag.set()
+
+# ============================================================
+# EVENT SCHEDULER (streaming mode)
+# ============================================================
+# The conductor fills ble.events ahead of time with EVENT frames stamped
+# relative to a shared start. Onsets are then timed by ticks_ms(), not by
+# when the radio delivered the frame.
+stream_start = None     # ticks_ms() of t=0, None while not streaming
+stream_ended = False    # conductor sent STREAM:END, an empty buffer is not an underrun
+stream_starved = False
+underruns = 0
+next_event = None       # head of the jitter buffer (deque has no peek)
+# How late stream / song events start against their schedule (the onset
+# less the strike lead), in ms; compare with USE_EXEC_THREAD on and off.
+start_late = 0
+start_late_max = 0
+start_late_sum = 0
+start_count = 0
+
+# What the peek_*() functions hand back. One shared list: callers read it
+# at once and never keep it.
+peek_out = [0, 0, 0]
+
+def peek_fill(idx, budget_ms, mask):
+    peek_out[0] = idx
+    peek_out[1] = budget_ms
+    peek_out[2] = mask
+    return peek_out
+
+def note_start(late):
+    global start_late, start_late_max, start_late_sum, start_count
+    start_late = late
+    if late > start_late_max:
+        start_late_max = late
+    start_late_sum += late
+    start_count += 1
+
+def start_stats_reset():
+    global start_late, start_late_max, start_late_sum, start_count
+    start_late = start_late_max = start_late_sum = start_count = 0
+
+def stream_reset():
+    global stream_start, stream_ended, stream_starved, underruns, next_event
+    while ble.take(ble.events) is not None:
+        pass
+    stream_start = None
+    stream_ended = False
+    stream_starved = False
+    underruns = 0
+    next_event = None
+    start_stats_reset()
+
+def stream_begin(lead_ms):
+    global stream_start
+    stream_start = time.ticks_add(time.ticks_ms(), lead_ms)
+
+def stream_finish():
+    global stream_ended
+    stream_ended = True
+
+def peek_stream():
+    global next_event
+    if next_event is None:
+        next_event = ble.take(ble.events)
+    if next_event is None:
+        return None
+    # The real deadline is the next onset, however early the move starts.
+    left = time.ticks_diff(time.ticks_add(stream_start, next_event[6]), time.ticks_ms())
+    return peek_fill(next_event[2], max(1, left - chord_lead(next_event[3])), next_event[3])
+
+async def stream_poll():
+    """Run the buffered event if it is due. Returns ms until the next onset,
+    0 if an event just ran, or -1 when nothing is waiting."""
+    global next_event, stream_starved, underruns
+    if stream_start is None:
+        return -1
+    if next_event is None:
+        if not ble.events:
+            if not stream_ended and not stream_starved:
+                stream_starved = True
+                underruns += 1
+            return -1
+        next_event = ble.take(ble.events)
+        stream_starved = False
+    # Due as soon as the slowest finger of the chord has to start moving.
+    wait = time.ticks_diff(time.ticks_add(stream_start, next_event[6]), time.ticks_ms())
+    wait -= chord_lead(next_event[3])
+    if wait > 0:
+        return wait
+    ev = next_event
+    next_event = None
+    note_start(-wait)
+    code = await handle_frame(ev, peek_stream)
+    # Report when the keys went down, not when the event started.
+    late = chord_late if ev[3] & 0x1F else -wait
+    ble.send_ack(ev[1], code, EVT_BUF_LEN - len(ble.events), late)
+    await move_ahead(peek_stream)
+    return 0
+
+# ============================================================
+# SONG LIBRARY (stored on flash)
+# ============================================================
+# A song file is a headerless run of fixed-size records:
+#   uint32 t_ms, int16 idx, uint8 finger mask, uint16 duration_ms, uint16 budget_ms
+# Playback reads SONG_CHUNK_RECS records at a time into one reusable
+# buffer, so RAM use does not grow with the length of the piece.
+SONG_DIR = "/songs"
+SONG_REC_FMT = "<IhBHH"
+SONG_REC_LEN = struct.calcsize(SONG_REC_FMT)
+SONG_CHUNK_RECS = 16
+SONG_LEAD_MS = 500
+
+song_upload = None      # file being written by SONG:OPEN + DATA frames
+song_file = None        # file being played
+song_buf = bytearray(SONG_REC_LEN * SONG_CHUNK_RECS)
+song_mv = memoryview(song_buf)
+song_len = 0            # valid bytes in song_buf
+song_pos = 0            # offset of the next record in song_buf
+song_rec = None         # next record to play
+song_recs = ([0] * 5, [0] * 5)  # record slots, used in turn by song_next()
+song_slot = 0
+song_start = 0
+song_count = 0
+song_late_max = 0
+
+try:
+    os.mkdir(SONG_DIR)
+except OSError:
+    pass
+
+def song_path(name):
+    if not name or "/" in name:
+        raise ValueError("bad name")
+    return SONG_DIR + "/" + name
+
+def song_write(data):
+    if song_upload is None:
+        return False
+    song_upload.write(data)
+    return True
+
+def song_stop():
+    global song_file, song_rec
+    if song_file is not None:
+        song_file.close()
+    song_file = None
+    song_rec = None
+
+def handle_song_command(cmd):
+    global song_upload, song_file, song_len, song_pos, song_start, song_count, song_late_max
+    if cmd.startswith("OPEN:"):
+        if song_upload is not None:
+            song_upload.close()
+        song_upload = open(song_path(cmd[5:]), "wb")
+        return "OK:OPEN"
+    elif cmd == "CLOSE":
+        if song_upload is None:
+            return "ERR:NOT_OPEN"
+        size = song_upload.tell()
+        song_upload.close()
+        song_upload = None
+        return "OK:SAVED=%d" % size
+    elif cmd == "LIST":
+        return "OK:" + ",".join(os.listdir(SONG_DIR))
+    elif cmd.startswith("PLAY:"):
+        song_stop()
+        song_file = open(song_path(cmd[5:]), "rb")
+        song_len = 0
+        song_pos = 0
+        song_count = 0
+        song_late_max = 0
+        start_stats_reset()
+        song_start = time.ticks_add(time.ticks_ms(), SONG_LEAD_MS)
+        return "OK:PLAYING"
+    elif cmd == "STOP":
+        song_stop()
+        return "OK:STOPPED"
+    elif cmd.startswith("DEL:"):
+        os.remove(song_path(cmd[4:]))
+        return "OK:DELETED"
+    return "ERR:UNKNOWN"
+
+def song_next():
+    """Next [t_ms, idx, mask, dur_ms, budget_ms] record from flash, or None at
+    end of file. The two slots alternate, so the record being played is
+    still intact while the one after it is read."""
+    global song_len, song_pos, song_slot
+    if song_pos >= song_len:
+        song_len = song_file.readinto(song_mv) or 0
+        song_pos = 0
+        if song_len < SONG_REC_LEN:
+            return None
+    # SONG_REC_FMT, field by field.
+    b = song_buf
+    p = song_pos
+    rec = song_recs[song_slot]
+    song_slot ^= 1
+    rec[0] = u32(b, p)
+    rec[1] = s16(b, p + 4)
+    rec[2] = b[p + 6]
+    rec[3] = u16(b, p + 7)
+    rec[4] = u16(b, p + 9)
+    song_pos += SONG_REC_LEN
+    return rec
+
+def peek_song():
+    global song_rec
+    if song_rec is None and song_file is not None:
+        song_rec = song_next()
+    if song_rec is None:
+        return None
+    left = time.ticks_diff(time.ticks_add(song_start, song_rec[0]), time.ticks_ms())
+    return peek_fill(song_rec[1], max(1, left - chord_lead(song_rec[2])), song_rec[2])
+
+async def song_poll():
+    """Same contract as stream_poll(), for a song playing from flash."""
+    global song_rec, song_count, song_late_max
+    if song_file is None:
+        return -1
+    if song_rec is None:
+        song_rec = song_next()
+        if song_rec is None:
+            song_stop()
+            # Not OK/ERR, so the conductor treats it as state, not as a command result.
+            ble.set_status("DONE:%d,MAXLATE=%d" % (song_count, song_late_max))
+            return -1
+    onset = time.ticks_add(song_start, song_rec[0])
+    wait = time.ticks_diff(onset, time.ticks_ms()) - chord_lead(song_rec[2])
+    if wait > 0:
+        return wait
+    rec = song_rec
+    song_rec = None
+    note_start(-wait)
+    await play_event(rec[1], rec[2], rec[3], rec[4], peek_song, onset)
+    song_count += 1
+    late = chord_late if rec[2] & 0x1F else -wait
+    if late > song_late_max:
+        song_late_max = late
+    await move_ahead(peek_song)
+    return 0
+
+# ============================================================
+# MEMORY (performance mode)
+# ============================================================
+# While a stream or song is playing (and perf_mode is set) the firmware
+# keeps the GC out of the way: the threshold is lifted so the VM does not
+# collect by itself, motion_task() collects in the gaps before onsets
+# instead, and nothing is printed. MEM reports the heap and GC figures.
+# Collections the VM runs on its own cannot be timed, only noticed
+# (heap use drops without gc_run()), and are counted as AUTO.
+GC_THRESHOLD_IDLE = 16 * 1024   # bytes allocated between collections otherwise
+GC_THRESHOLD_PLAY = -1          # during a performance: only when the heap is full
+GC_MIN_GARBAGE = 2 * 1024       # less than this since the last collection: skip it
+GC_GAP_MS = 10                  # never collect in a shorter gap ...
+GC_MARGIN_US = 2000             # ... or one with less than this to spare over the slowest collection
+MAXBLK_WAIT_MS = 200            # how long MEM waits for motion_task() to probe
+
+perf_mode = True    # CAL:PERF:ON|OFF
+perf_on = False     # a performance is running under perf_mode
+gc_count = 0        # gc_run() collections
+gc_auto = 0         # collections the VM ran by itself
+gc_us = 0           # duration of the last gc_run()
+gc_us_max = 0
+gc_us_sum = 0
+gc_seen = 0         # gc.mem_alloc() at the last look
+gc_base = 0         # ... and just after the last collection
+maxblk = -1         # largest_block() at the last probe
+maxblk_req = False  # MEM wants a fresh one
+maxblk_done = asyncio.Event()
+
+def gc_run():
+    global gc_count, gc_us, gc_us_max, gc_us_sum, gc_seen, gc_base
+    t0 = time.ticks_us()
+    gc.collect()
+    gc_us = time.ticks_diff(time.ticks_us(), t0)
+    if gc_us > gc_us_max:
+        gc_us_max = gc_us
+    gc_us_sum += gc_us
+    gc_count += 1
+    gc_seen = gc_base = gc.mem_alloc()
+
+def gc_stats_reset():
+    global gc_count, gc_auto, gc_us, gc_us_max, gc_us_sum
+    gc_count = gc_auto = gc_us = gc_us_max = gc_us_sum = 0
+
+def gc_idle(wait):
+    """Collect in a gap of wait ms before the next onset, if it is long
+    enough and there is garbage worth it. Returns True if it did."""
+    if wait < GC_GAP_MS or wait * 1000 < gc_us_max + GC_MARGIN_US:
+        return False
+    if gc.mem_alloc() - gc_base < GC_MIN_GARBAGE:
+        return False
+    gc_run()
+    return True
+
+def performing():
+    if song_file is not None:
+        return True
+    return stream_start is not None and not (stream_ended and next_event is None and not ble.events)
+
+def mem_tick():
+    """Run by motion_task() each time round: count collections the VM ran
+    by itself, and switch performance mode on or off with playback."""
+    global gc_auto, gc_seen, gc_base, perf_on
+    a = gc.mem_alloc()
+    if a < gc_seen:
+        gc_auto += 1
+        gc_base = a
+    gc_seen = a
+    on = perf_mode and performing()
+    if on == perf_on:
+        return
+    perf_on = on
+    if on:
+        gc_run()    # start clean
+        gc.threshold(GC_THRESHOLD_PLAY)
+    else:
+        gc.threshold(GC_THRESHOLD_IDLE)
+
+def largest_block():
+    """Largest bytearray the heap can hold right now, found by bisection.
+    Every miss forces a collection, so only mem_probe() calls it. Its
+    collections stay out of the GC figures gc_idle() plans with."""
+    global gc_seen, gc_base
+    lo, hi = 0, gc.mem_free()
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        try:
+            b = bytearray(mid)
+            lo = mid
+        except MemoryError:
+            hi = mid - 1
+        b = None
+    gc.collect()
+    gc_seen = gc_base = gc.mem_alloc()
+    return lo
+
+def mem_probe():
+    """Run by motion_task() when it has nothing queued or due: answer a
+    pending MEM request with a fresh largest_block()."""
+    global maxblk, maxblk_req
+    maxblk = largest_block()
+    maxblk_req = False
+    maxblk_done.set()
+
+# ============================================================
+# TASKS
+# ============================================================
+# Nothing polls: intake_task() sleeps on ble.rx_flag and motion_task() on
+# motion_wake (or until the next onset is due).
+#
+# USE_EXEC_THREAD runs all of the tasks below on a second _thread, fed
+# through the lock-protected ble.queue / ble.events, while the main thread
+# sleeps in front_end() and only runs the BLE callbacks and the scheduled
+# flush_outbox() that sends the executor's notifications. Note that
+# on the ESP32 port MicroPython threads share one core and the GIL, and a
+# GC pauses both threads: this keeps radio work from running *inside*
+# executor code, it does not make the two truly parallel. SLATE in STATUS
+# shows whether it helps on a given build.
+USE_EXEC_THREAD = False   # off until SLATE on the rig shows it helps
+EXEC_STACK = 16 * 1024
+FRONT_IDLE_MS = 1000    # front_end() backstop, for a flush schedule() had no room for
+jobs = deque((), QUEUE_LEN)     # motion work handed over by intake_task()
+lookahead = None    # job already taken off 'jobs' by peek_queue()
+busy = False
+motion = None       # the motion_task() Task, restarted by ABORT
+motion_wake = asyncio.Event()   # new job, or a command that may have started a stream/song
+
+def set_busy(state):
+    """Track the motion task's state and notify BUSY/READY on a change. The
+    notification is queued before the job runs, so it goes out first."""
+    global busy
+    if state != busy:
+        busy = state
+        ble.set_status(b"BUSY" if state else b"READY")
+
+def peek_queue():
+    global lookahead
+    if lookahead is None and jobs:
+        lookahead = jobs.popleft()
+    if isinstance(lookahead, tuple) and lookahead[0] == OP_PLAY:
+        return peek_fill(lookahead[2], lookahead[5], lookahead[3])
+    return None
+
+async def run_job(job):
+    if isinstance(job, tuple):
+        code = await handle_frame(job, peek_queue)
+        ble.send_ack(job[1], code, QUEUE_LEN - ble.backlog())
+        await move_ahead(peek_queue)
+        return
+    resp = await handle_command(job)
+    if not perf_on:
+        print("[CMD]", job, "->", resp)
+    # Notify the real result; the conductor resolves its pending command on OK/ERR.
+    ble.set_status(resp)
+
+async def motion_task():
+    """Owns the stepper and the strike/hold sequence: queued jobs first,
+    then whatever the stream or stored song has due."""
+    global lookahead
+    while True:
+        motion_wake.clear()
+        if lookahead is not None or jobs:
+            if lookahead is not None:
+                job, lookahead = lookahead, None
+            else:
+                job = jobs.popleft()
+            set_busy(True)
+            await run_job(job)
+            continue
+        set_busy(False)
+        mem_tick()
+        wait = await stream_poll()
+        if wait == 0:
+            continue
+        song_wait = await song_poll()
+        if song_wait == 0:
+            continue
+        if song_wait > 0 and (wait < 0 or song_wait < wait):
+            wait = song_wait
+        mem_tick()
+        if perf_on and wait > 0 and gc_idle(wait):
+            wait = max(1, wait - gc_us // 1000)
+        elif maxblk_req and wait < 0 and not perf_on:
+            mem_probe()
+        # Sleep until the next onset, or until intake_task() has news.
+        try:
+            if wait < 0:
+                await motion_wake.wait()
+            else:
+                await asyncio.wait_for_ms(motion_wake.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+def abort():
+    """Drop all pending work and open every finger. A move already sent to
+    the drive finishes on its own; current_deg is booked before it is sent."""
+    global motion, lookahead
+    while jobs:
+        jobs.popleft()
+    lookahead = None
+    stream_reset()
+    song_stop()
+    if motion is not None:
+        motion.cancel()
+    release_all()
+    set_busy(False)
+    motion = asyncio.create_task(motion_task())
+
+async def intake_task():
+    """Moves commands off the BLE queue: motion work to 'jobs', the rest is answered now."""
     while True:
-        if ble.queue:
-            cmd = ble.queue.popleft()
-            ble.set_status("BUSY")
-            time.sleep_ms(30)
-            resp = handle_command(cmd)
-            print("[CMD]", cmd, "->", resp)
-            ble.set_status("READY")
-        time.sleep_ms(20)
+        await ble.rx_flag.wait()
+        while ble.queue:
+            cmd = ble.take(ble.queue)
+            if isinstance(cmd, tuple) or is_motion_command(cmd):
+                jobs.append(cmd)
+                motion_wake.set()
+                continue
+            resp = await handle_command(cmd)
+            if not perf_on:
+                print("[CMD]", cmd, "->", resp)
+            ble.set_status(resp)
+        # EVENT frames, STREAM:START, SONG:PLAY ... give the scheduler a look.
+        motion_wake.set()
 
-main()
+async def main():
+    """The executor: every uasyncio task, on whichever thread runs it."""
+    global motion
+    release_all()
+    gc.threshold(GC_THRESHOLD_IDLE)
+    print("ESP32 Piano v2 ready. Home = rightmost key.")
+    motion = asyncio.create_task(motion_task())
+    asyncio.create_task(servo_task())
+    await intake_task()
 
+def front_end():
+    """Main thread in threaded mode. BLE callbacks, the rx_lines()
+    reassembly and flush_outbox() are scheduled onto this thread and run
+    while it sleeps here; nothing polls."""
+    while True:
+        time.sleep_ms(FRONT_IDLE_MS)
+        ble.flush_outbox()
+
+def start():
+    global ble
+    threaded = USE_EXEC_THREAD and _thread is not None
+    ble = BLEPeripheral(threaded)
+    if not threaded:
+        asyncio.run(main())
+        return
+    _thread.stack_size(EXEC_STACK)
+    _thread.start_new_thread(asyncio.run, (main(),))
+    front_end()
 
+start()
@@ -15,11 +15,15 @@ CSV Interpretation:
   - 'finger' = Servo number to press (1~5)
   - 'thumb_pos' column is not used
   - If there are multiple fingers at the same (timestamp, key), they will be pressed simultaneously
+  - Optional 'end_time' (or 'duration') gives the note-off; without it a note is
+    held until the hand has to leave for the next one
 """
 import asyncio
 import time
 import csv
-from collections import OrderedDict
+import os
+import struct
+from collections import OrderedDict, deque
 from bleak import BleakScanner, BleakClient
 
 # ============================================================
@@ -31,7 +35,49 @@ TX_UUID = "19b10002-e8f2-537e-4f6c-d104768a1214"
 
 CSV_PATH = "fingering_plan.csv"
 INCLUDE_LEFT_HAND = False   # If changed to True, 'L' rows are processed identical to the right hand
-CHUNK_SIZE = 20
+CHUNK_SIZE = 20             # Text write size until a larger MTU has been negotiated
+
+# Binary frames (must match esp32_piano.py); crc = sum of the other bytes & 0xFF.
+OP_PLAY   = 0xA1
+OP_EVENT  = 0xA2
+OP_DATA   = 0xA3            # opcode, seq, payload, crc (song upload)
+OP_ACK    = 0xB1
+# PLAY: opcode, seq, int16 idx, finger mask, uint16 duration_ms,
+#       uint16 travel budget_ms (0 = no deadline), crc
+FRAME_FMT = "<BBhBHH"
+EVENT_FMT = "<BBhBHHI"      # PLAY fields + uint32 onset ms after stream start
+# ACK: OP_ACK, seq, result code, free queue slots, last seq accepted by the device,
+#      int16 ms the keys went down after the onset, underrun count
+ACK_FMT   = "<BBBBBhB"
+ACK_LEN   = struct.calcsize(ACK_FMT)
+ACK_TEXT  = {0: "OK", 1: "ERR:FRAME", 2: "ERR:CRC", 3: "ERR:OVERFLOW"}
+WINDOW = 8                  # PLAY frames kept in flight (device queue holds 32)
+
+STREAM_MODE = True          # Send timestamped events ahead; the ESP32 clock times the onsets
+STREAM_WINDOW = 48          # Events buffered ahead (device jitter buffer holds 64)
+STREAM_LEAD_MS = 500        # Delay between STREAM:START and t=0
+
+# Stored song record (must match SONG_REC_FMT in esp32_piano.py):
+#   uint32 t_ms, int16 idx, uint8 finger mask, uint16 duration_ms, uint16 budget_ms
+SONG_REC_FMT = "<IhBHH"
+UPLOAD_ACK_TIMEOUT_S = 10.0 # An upload with no ACK for this long has stalled (a lost ACK never comes)
+UPLOAD_TRIES = 2            # Attempts before giving up; SONG:OPEN starts the file over
+
+# Starting guess for a finger's strike latency (CLOSE sent -> key down, from
+# hover): servo dead time plus travel time for the HOVER->CLOSE PWM distance.
+# Hobby servos do ~60 deg per 100 ms, about 0.75 ms per PCA9685 tick at 50 Hz.
+SERVO_DEAD_MS = 10
+SERVO_MS_PER_TICK = 0.75
+
+# Note-off planning. A chord is released by the time the hand has to leave
+# for the next key: LEAVE_BASE_S + LEAVE_PER_KEY_S per key of travel before
+# the next onset, or RESTRIKE_GAP_S before it if a finger strikes again on
+# the same key. Holds never drop below MIN_HOLD_S.
+MIN_HOLD_S = 0.1
+LEAVE_BASE_S = 0.15
+LEAVE_PER_KEY_S = 0.03
+RESTRIKE_GAP_S = 0.08
+LAST_HOLD_S = 0.5           # Last note, when the CSV gives no note-off
 
 # ============================================================
 # KEY NAME <-> INDEX
@@ -52,6 +98,28 @@ def key_to_idx(name):
 def idx_to_key(idx):
     return f"{NOTE_NAMES[idx % 7]}{idx // 7}"
 
+MASK_RESTRIKE = 0x80        # finger-mask flag: same key and finger(s) as the previous event
+
+def finger_mask(fingers, restrike=False):
+    mask = MASK_RESTRIKE if restrike else 0
+    for f in fingers:
+        if 1 <= f <= 5:
+            mask |= 1 << (f - 1)
+    return mask
+
+def to_ms16(sec):
+    return max(0, min(int(round(sec * 1000)), 0xFFFF))
+
+def encode_play(seq, rel, fingers, dur_s, budget_s=0, restrike=False):
+    data = struct.pack(FRAME_FMT, OP_PLAY, seq & 0xFF, rel, finger_mask(fingers, restrike),
+                       to_ms16(dur_s), to_ms16(budget_s))
+    return data + bytes([sum(data) & 0xFF])
+
+def encode_event(seq, t_s, rel, fingers, dur_s, budget_s=0, restrike=False):
+    data = struct.pack(EVENT_FMT, OP_EVENT, seq & 0xFF, rel, finger_mask(fingers, restrike),
+                       to_ms16(dur_s), to_ms16(budget_s), int(round(t_s * 1000)))
+    return data + bytes([sum(data) & 0xFF])
+
 # ============================================================
 # ASYNC INPUT HELPER
 # ============================================================
@@ -62,41 +130,132 @@ async def ainput(prompt=""):
 # ============================================================
 # BLE TRANSPORT
 # ============================================================
-async def send_cmd(client, cmd, timeout_s=20.0):
-    payload = (cmd + "\n").encode('utf-8')
-    for i in range(0, len(payload), CHUNK_SIZE):
-        await client.write_gatt_char(RX_UUID, payload[i:i+CHUNK_SIZE], response=True)
-        await asyncio.sleep(0.02)
-    # Wait for BUSY (up to 1s); if READY seen first, command was instant.
-    busy_seen = False
-    for _ in range(20):
-        await asyncio.sleep(0.05)
-        try:
-            status = (await client.read_gatt_char(TX_UUID)).decode('utf-8', errors='ignore').strip()
-        except Exception:
-            continue
-        if status == "BUSY":
-            busy_seen = True
-            break
-        if status == "READY":
-            return
-    if busy_seen:
-        deadline = time.time() + timeout_s
-        while time.time() < deadline:
-            await asyncio.sleep(0.05)
+class PianoLink:
+    """BleakClient wrapper that resolves one future per command from TX notifications.
+    The firmware notifies the handle_command() result ("OK:..." / "ERR:...") on TX
+    when a command finishes, so no GATT reads are needed to detect completion.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.status = None
+        self.pending = deque()
+        self.frames = {}        # seq -> future for binary frames
+        self.seq = 0
+        self.write_size = CHUNK_SIZE
+        self.credits = WINDOW
+        self.credit_event = asyncio.Event()
+        self.overflows = 0
+        self.late_log = []      # late_ms of every successful ACK (always 0 for PLAY)
+        self.underruns = 0
+        self.status_event = asyncio.Event()
+
+    async def start(self):
+        await self.negotiate_mtu()
+        await self.client.start_notify(TX_UUID, self._on_notify)
+
+    async def negotiate_mtu(self):
+        """Use the largest ATT MTU the link agreed on, so a whole command fits in one write."""
+        backend = getattr(self.client, "_backend", None)
+        if hasattr(backend, "_acquire_mtu"):
+            # BlueZ only learns the exchanged MTU on demand.
             try:
-                status = (await client.read_gatt_char(TX_UUID)).decode('utf-8', errors='ignore').strip()
+                await backend._acquire_mtu()
             except Exception:
-                continue
-            if status == "READY":
-                return
+                pass
+        mtu = self.client.mtu_size or 23
+        self.write_size = max(CHUNK_SIZE, mtu - 3)
+        print(f"  ATT MTU: {mtu} (write size {self.write_size} bytes)")
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xFF
+        return self.seq
+
+    async def acquire_credit(self, timeout_s, window=WINDOW):
+        """Wait until both the local window and the device queue have room."""
+        while len(self.frames) >= window or self.credits <= 0:
+            self.credit_event.clear()
+            await asyncio.wait_for(self.credit_event.wait(), timeout_s)
+        self.credits -= 1
+
+    def _on_notify(self, _sender, data):
+        data = bytes(data)
+        if len(data) == ACK_LEN and data[0] == OP_ACK:
+            _, seq, code, free, rx_seq, late_ms, underruns = struct.unpack(ACK_FMT, data)
+            # Frames sent after rx_seq were not yet counted in 'free'.
+            self.credits = free - ((self.seq - rx_seq) & 0xFF)
+            self.credit_event.set()
+            self.underruns = underruns
+            if code == 0:
+                self.late_log.append(late_ms)
+            elif code == 3:
+                self.overflows += 1
+            fut = self.frames.pop(seq, None)
+            if fut is not None and not fut.done():
+                fut.set_result(ACK_TEXT.get(code, f"ERR:{code}"))
+            return
+        msg = data.decode('utf-8', errors='ignore').strip()
+        self.status = msg
+        if not msg.startswith(("OK", "ERR")):
+            self.status_event.set()
+            return   # READY / BUSY / DONE are state only
+        # Commands complete in order; a timed-out future is still popped here
+        # so a late response never gets matched to the next command.
+        if self.pending:
+            fut = self.pending.popleft()
+            if not fut.done():
+                fut.set_result(msg)
+
+async def send_cmd(link, cmd, timeout_s=20.0):
+    """Send one text command and wait for its response string.
+    Returns the firmware's reply (e.g. "OK:PLAY", "ERR:...") or None on timeout."""
+    fut = asyncio.get_running_loop().create_future()
+    link.pending.append(fut)
+    payload = (cmd + "\n").encode('utf-8')
+    n = link.write_size
+    for i in range(0, len(payload), n):
+        await link.client.write_gatt_char(RX_UUID, payload[i:i+n], response=True)
+    try:
+        return await asyncio.wait_for(fut, timeout_s)
+    except asyncio.TimeoutError:
         print(f"  [WARN] timeout after: {cmd}")
+        return None
+
+async def submit_play(link, rel, fingers, dur_s, budget_s=0, restrike=False, timeout_s=10.0):
+    """Queue one binary PLAY frame without waiting for it to be played.
+    Blocks only while the send window is full. Returns a future that resolves
+    to "OK:PLAY" / "ERR:..." when the device reports the frame done."""
+    await link.acquire_credit(timeout_s)
+    seq = link.next_seq()
+    fut = asyncio.get_running_loop().create_future()
+    link.frames[seq] = fut
+    await link.client.write_gatt_char(RX_UUID, encode_play(seq, rel, fingers, dur_s, budget_s, restrike), response=True)
+    return fut
+
+async def submit_data(link, payload, timeout_s=10.0):
+    await link.acquire_credit(timeout_s)
+    seq = link.next_seq()
+    fut = asyncio.get_running_loop().create_future()
+    link.frames[seq] = fut
+    data = bytes([OP_DATA, seq]) + payload
+    await link.client.write_gatt_char(RX_UUID, data + bytes([sum(data) & 0xFF]), response=True)
+    return fut
+
+async def submit_event(link, t_s, rel, fingers, dur_s, budget_s=0, restrike=False, timeout_s=60.0):
+    """Like submit_play, but the frame carries its onset time and goes into the
+    device jitter buffer. The future resolves once the device has played it."""
+    await link.acquire_credit(timeout_s, STREAM_WINDOW)
+    seq = link.next_seq()
+    fut = asyncio.get_running_loop().create_future()
+    link.frames[seq] = fut
+    await link.client.write_gatt_char(RX_UUID, encode_event(seq, t_s, rel, fingers, dur_s, budget_s, restrike), response=True)
+    return fut
 
 # ============================================================
 # CSV LOADING
 # ============================================================
 def load_csv(path, include_left=False):
-    """Returns raw list [(t, key, finger)], min_key, max_key."""
+    """Returns raw list [(t, key, finger, t_off)], min_key, max_key.
+    t_off is None when the row has no usable 'end_time' / 'duration'."""
     raw = []
     keys = set()
     with open(path, 'r', encoding='utf-8') as f:
@@ -111,7 +270,17 @@ def load_csv(path, include_left=False):
                 _ = key_to_idx(k)  # validate
             except Exception:
                 continue
-            raw.append((t, k, f_))
+            t_off = None
+            try:
+                if row.get('end_time'):
+                    t_off = float(row['end_time'])
+                elif row.get('duration'):
+                    t_off = t + float(row['duration'])
+            except ValueError:
+                pass
+            if t_off is not None and t_off <= t:
+                t_off = None
+            raw.append((t, k, f_, t_off))
             keys.add(k)
     raw.sort(key=lambda x: (x[0], key_to_idx(x[1]), x[2]))
     if keys:
@@ -119,24 +288,57 @@ def load_csv(path, include_left=False):
         return raw, sorted_keys[0], sorted_keys[-1]
     return raw, None, None
 
+def release_by(items, i):
+    """Latest note-off for chord i of items [((t, rel), fingers)] that still
+    leaves the hand time for what follows: the first later event on another
+    key, or that strikes one of the same fingers again. None if there is none.
+    Events on the same key with other fingers can sound over the hold."""
+    (t, rel), fingers = items[i]
+    for (t_next, rel_next), fingers_next in items[i+1:]:
+        if rel_next != rel:
+            return t_next - LEAVE_BASE_S - LEAVE_PER_KEY_S * abs(rel_next - rel)
+        if set(fingers) & set(fingers_next):
+            return t_next - RESTRIKE_GAP_S
+    return None
+
 def build_events(raw, home_key):
-    """(t, key, finger)* ->  (t, rel_idx, [fingers], duration)*
+    """(t, key, finger, t_off)* ->  (t, rel_idx, [fingers], duration, budget, restrike)*
     rel_idx = home_idx - key_idx. Positive = Left direction from home (lower notes).
+    duration = note-off from the CSV (latest of the chord), cut short where the
+    hand has to leave for the next key (see release_by); without a note-off the
+    chord is held until then. The ESP32 releases on a timer, so the hold does
+    not delay the next command.
+    budget = time from the previous release to this onset, i.e. how long the
+    hand has to travel; the ESP32 picks the move speed from it (0 = no deadline).
+    restrike = same hand position and at least one of the same fingers as the
+    previous event; the ESP32 then lifts those fingers only to hover height.
     """
     home_idx = key_to_idx(home_key)
     groups = OrderedDict()
-    for t, k, f_ in raw:
+    offs = {}
+    for t, k, f_, t_off in raw:
         rel = home_idx - key_to_idx(k)
         groups.setdefault((t, rel), []).append(f_)
+        if t_off is not None:
+            offs[(t, rel)] = max(offs.get((t, rel), t_off), t_off)
     items = list(groups.items())
     out = []
     for i, ((t, rel), fingers) in enumerate(items):
-        if i + 1 < len(items):
-            dur = items[i+1][0][0] - t
-            dur = max(0.2, min(dur, 1.0))
+        t_off = offs.get((t, rel))
+        leave = release_by(items, i)
+        if t_off is None:
+            t_off = leave if leave is not None else t + LAST_HOLD_S
+        elif leave is not None:
+            t_off = min(t_off, leave)
+        dur = max(MIN_HOLD_S, t_off - t)
+        if out:
+            prev_t, prev_rel, prev_fingers, prev_dur, _, _ = out[-1]
+            budget = max(0.001, t - (prev_t + prev_dur))
+            restrike = rel == prev_rel and bool(set(fingers) & set(prev_fingers))
         else:
-            dur = 0.5
-        out.append((t, rel, fingers, dur))
+            budget = 0
+            restrike = False
+        out.append((t, rel, fingers, dur, budget, restrike))
     return out
 
 # ============================================================
@@ -146,7 +348,7 @@ def hline(): print("-" * 64)
 def header(s):
     print(); hline(); print(f"  {s}"); hline()
 
-async def calibrate_stepper(client, suggested_home):
+async def calibrate_stepper(link, suggested_home):
     """Interactive stepper calibration.
     Returns (home_key, signed_step_deg)."""
     header("STEP 1  Set Home (Rightmost Key)")
@@ -166,7 +368,7 @@ async def calibrate_stepper(client, suggested_home):
             c = (await ainput(f"  Confirm '{s}' as Home? [y=Confirm, j=JOG tune, n=Retry]: ")).strip().lower()
             if c == 'y':
                 home_key = s
-                await send_cmd(client, "CAL:SET_HOME")
+                await send_cmd(link, "CAL:SET_HOME")
                 print(f"  ✓ Home = {home_key}")
                 break
             elif c == 'j':
@@ -175,7 +377,7 @@ async def calibrate_stepper(client, suggested_home):
                     if not j:
                         break
                     try:
-                        await send_cmd(client, f"CAL:JOG:{float(j)}")
+                        await send_cmd(link, f"CAL:JOG:{float(j)}")
                     except ValueError:
                         print("    Numbers only")
                 # Break to outer loop to ask for current position again after JOG
@@ -201,7 +403,7 @@ async def calibrate_stepper(client, suggested_home):
                 break
             except ValueError:
                 print("  Numbers only")
-        await send_cmd(client, f"CAL:JOG:{jog_deg}")
+        await send_cmd(link, f"CAL:JOG:{jog_deg}")
 
         while True:
             new_name = (await ainput("  Key reached after moving (e.g., A4): ")).strip()
@@ -220,12 +422,12 @@ async def calibrate_stepper(client, suggested_home):
         signed_step = jog_deg / diff
         print(f"  → Moved {abs(jog_deg):.2f} degrees, key difference is {abs(diff)} steps")
         print(f"  → step_degrees = {signed_step:+.4f}  (Rotation angle per index +1)")
-        await send_cmd(client, f"CAL:SET_STEP:{signed_step:.6f}")
+        await send_cmd(link, f"CAL:SET_STEP:{signed_step:.6f}")
 
         # Restore physical position to home by reverse JOG
         # (current_deg remains 0 on the ESP32, physical must also return to home to sync)
         print("  → Physically returning to Home...")
-        await send_cmd(client, f"CAL:JOG:{-jog_deg}")
+        await send_cmd(link, f"CAL:JOG:{-jog_deg}")
 
         c = (await ainput("  Measure again? [y=Retry, Enter=Confirm]: ")).strip().lower()
         if c != 'y':
@@ -244,7 +446,7 @@ async def calibrate_stepper(client, suggested_home):
             print("  Invalid format")
             continue
         rel = key_to_idx(home_key) - tgt_idx
-        await send_cmd(client, f"CAL:GOTO:{rel}")
+        await send_cmd(link, f"CAL:GOTO:{rel}")
         actual = (await ainput(f"    Actually reached key (Expected {s}, Enter=OK): ")).strip()
         if actual and actual != s:
             try:
@@ -253,27 +455,30 @@ async def calibrate_stepper(client, suggested_home):
                     new_step = signed_step * (rel / actual_rel)
                     print(f"    Re-tuned step_degrees = {new_step:+.4f}")
                     signed_step = new_step
-                    await send_cmd(client, f"CAL:SET_STEP:{signed_step:.6f}")
+                    await send_cmd(link, f"CAL:SET_STEP:{signed_step:.6f}")
             except Exception:
                 pass
         # Return to Home
-        await send_cmd(client, "CAL:GOTO:0")
+        await send_cmd(link, "CAL:GOTO:0")
 
     print(f"\n  Final: Home={home_key}, step_degrees={signed_step:+.4f}")
     return home_key, signed_step
 
-async def calibrate_servos(client):
+async def calibrate_servos(link):
     header("STEP 4  Servo PWM Calibration (Ch 0~4)")
-    print("  Adjust the OPEN (release) / CLOSE (press) PWM values for each finger.")
+    print("  Adjust the OPEN (release) / CLOSE (press) / HOVER (just above the key) PWM values for each finger.")
     print("  Standard values: OPEN≈205 (1.0ms), CLOSE≈410 (2.0ms)")
-    print("  The current defaults of 150/500 are extreme and servos might not move, adjustment is recommended.\n")
+    print("  The current defaults of 150/500 are extreme and servos might not move, adjustment is recommended.")
+    print("  HOVER is where a finger waits while the hand travels and between re-strikes;")
+    print("  set it as close to the key as possible without touching it.\n")
 
+    travel = []
     for ch in range(5):
         print(f"-- Channel {ch} (Finger {ch+1}) --")
         opw, cpw = 150, 500
         while True:
-            await send_cmd(client, f"CAL:SET_SERVO:{ch}:{opw}:{cpw}")
-            await send_cmd(client, f"CAL:TEST_SERVO:{ch}:OPEN")
+            await send_cmd(link, f"CAL:SET_SERVO:{ch}:{opw}:{cpw}")
+            await send_cmd(link, f"CAL:TEST_SERVO:{ch}:OPEN")
             s = (await ainput(f"  OPEN PWM (Current {opw}, Number=Change, Enter=Keep): ")).strip()
             if not s:
                 break
@@ -282,8 +487,8 @@ async def calibrate_servos(client):
             except ValueError:
                 print("  Numbers only")
         while True:
-            await send_cmd(client, f"CAL:SET_SERVO:{ch}:{opw}:{cpw}")
-            await send_cmd(client, f"CAL:TEST_SERVO:{ch}:CLOSE")
+            await send_cmd(link, f"CAL:SET_SERVO:{ch}:{opw}:{cpw}")
+            await send_cmd(link, f"CAL:TEST_SERVO:{ch}:CLOSE")
             s = (await ainput(f"  CLOSE PWM (Current {cpw}, Number=Change, Enter=Keep): ")).strip()
             if not s:
                 break
@@ -291,17 +496,77 @@ async def calibrate_servos(client):
                 cpw = int(s)
             except ValueError:
                 print("  Numbers only")
-        await send_cmd(client, f"CAL:TEST_SERVO:{ch}:OPEN")
-        print(f"  ✓ Channel {ch}: OPEN={opw}, CLOSE={cpw}\n")
+        hpw = (opw + cpw) // 2
+        while True:
+            await send_cmd(link, f"CAL:SET_SERVO:{ch}:{opw}:{cpw}:{hpw}")
+            await send_cmd(link, f"CAL:TEST_SERVO:{ch}:HOVER")
+            s = (await ainput(f"  HOVER PWM (Current {hpw}, Number=Change, Enter=Keep): ")).strip()
+            if not s:
+                break
+            try:
+                hpw = int(s)
+            except ValueError:
+                print("  Numbers only")
+        await send_cmd(link, f"CAL:TEST_SERVO:{ch}:OPEN")
+        travel.append(abs(cpw - hpw))
+        print(f"  ✓ Channel {ch}: OPEN={opw}, CLOSE={cpw}, HOVER={hpw}\n")
+
+    await calibrate_latency(link, travel)
+
+async def calibrate_latency(link, travel):
+    """Per-finger strike latency. Finger 1's absolute value is entered (the
+    estimate comes from its PWM travel); every other finger is then tuned by
+    ear against finger 1 until the pair sounds as a single note."""
+    header("STEP 5  Strike Latency (CLOSE -> key down)")
+    print("  Each finger's CLOSE is sent early by its latency so chords land together, on time.")
+    print("  Finger 1 is the reference; the others are matched to it by ear.\n")
+    lats = [round(SERVO_DEAD_MS + SERVO_MS_PER_TICK * t) for t in travel]
+    for ch in range(5):
+        mask = 1 | (1 << ch)
+        while True:
+            await send_cmd(link, f"CAL:SET_LAT:{ch}:{lats[ch]}")
+            resp = await send_cmd(link, f"CAL:TEST_CHORD:{mask}")
+            if ch == 0:
+                prompt = f"  Finger 1 latency ms (Current {lats[0]}, Number=Change, Enter=Keep): "
+            else:
+                print(f"  Fingers 1+{ch+1} struck together ({resp}). Late finger {ch+1} -> raise, early -> lower.")
+                prompt = f"  Finger {ch+1} latency ms (Current {lats[ch]}, Number=Change, T=Test again, Enter=Keep): "
+            s = (await ainput(prompt)).strip().upper()
+            if not s:
+                break
+            if s == "T":
+                continue
+            try:
+                lats[ch] = max(0, int(s))
+            except ValueError:
+                print("  Numbers only")
+        print(f"  ✓ Finger {ch+1}: latency={lats[ch]}ms\n")
+    print(f"  Latencies: {lats}  (set manually with CAL:SET_LAT:<ch>:<ms>)")
 
 # ============================================================
 # PERFORM
 # ============================================================
-async def perform(client, events, home_key):
+async def perform(link, events, home_key):
+    """Frames are released at their scheduled time but not awaited: up to WINDOW
+    stay queued on the device, so the next PLAY is already there when the
+    current move+hold finishes. Results are collected as ACKs come back."""
     print(f"\n=== Performance Started — {len(events)} events, Home={home_key} ===")
     start = time.time()
     skipped = 0
-    for t, rel, fingers, dur in events:
+    errors = 0
+    latencies = []
+    inflight = []
+    overflows_before = link.overflows
+
+    def on_done(fut, t0, desc):
+        nonlocal errors
+        latencies.append(time.perf_counter() - t0)
+        resp = None if fut.cancelled() else fut.result()
+        if resp is None or resp.startswith("ERR"):
+            errors += 1
+            print(f"  [WARN] {desc} -> {resp}")
+
+    for t, rel, fingers, dur, budget, restrike in events:
         if rel < 0:
             skipped += 1
             continue
@@ -310,11 +575,169 @@ async def perform(client, events, home_key):
         if target_abs > now:
             await asyncio.sleep(target_abs - now)
         fstr = ','.join(str(f) for f in fingers)
-        cmd = f"PLAY:{rel}|{fstr};{dur:.3f}"
-        print(f"  [{t:6.2f}s] idx={rel:2d}  fingers={fstr}  dur={dur:.2f}")
-        await send_cmd(client, cmd, timeout_s=10.0)
+        print(f"  [{t:6.2f}s] idx={rel:2d}  fingers={fstr}  dur={dur:.2f}  inflight={len(link.frames)}")
+        t0 = time.perf_counter()
+        try:
+            fut = await submit_play(link, rel, fingers, dur, budget, restrike)
+        except asyncio.TimeoutError:
+            print("  [WARN] Device stopped returning credits; aborting performance")
+            break
+        fut.add_done_callback(lambda f, t0=t0, d=f"PLAY idx={rel} fingers={fstr}": on_done(f, t0, d))
+        inflight.append(fut)
+
+    pending = [f for f in inflight if not f.done()]
+    if pending:
+        _, late = await asyncio.wait(pending, timeout=10.0)
+        for f in late:
+            f.cancel()
+        if late:
+            print(f"  [WARN] {len(late)} PLAY frames never completed")
+    link.frames.clear()
+    link.credits = WINDOW
+
+    if skipped:
+        print(f"  [WARN] Skipped {skipped} events further right than Home (negative idx)")
+    if errors:
+        print(f"  [WARN] {errors} commands failed or timed out")
+    if link.overflows > overflows_before:
+        print(f"  [WARN] Device queue overflowed {link.overflows - overflows_before} times")
+    if latencies:
+        latencies.sort()
+        print(f"  Command latency (queue+move+hold): median={latencies[len(latencies)//2]*1000:.0f}ms "
+              f"max={latencies[-1]*1000:.0f}ms")
+    print("=== Performance Finished ===\n")
+
+async def perform_stream(link, events, home_key):
+    """Streaming mode: every event is sent ahead with its onset time. The
+    first STREAM_WINDOW events are buffered before the start is agreed, the
+    rest are refilled as the device hands credits back."""
+    print(f"\n=== Streaming Performance — {len(events)} events, Home={home_key} ===")
+    playable = [e for e in events if e[1] >= 0]
+    skipped = len(events) - len(playable)
+    await send_cmd(link, "STREAM:RESET")
+    link.frames.clear()
+    link.credits = STREAM_WINDOW
+    link.late_log.clear()
+    futs = []
+    started = False
+    for i, (t, rel, fingers, dur, budget, restrike) in enumerate(playable):
+        if i == STREAM_WINDOW:
+            await send_cmd(link, f"STREAM:START:{STREAM_LEAD_MS}")
+            start = time.time() + STREAM_LEAD_MS / 1000
+            started = True
+        try:
+            futs.append(await submit_event(link, t, rel, fingers, dur, budget, restrike))
+        except asyncio.TimeoutError:
+            print("  [WARN] Device stopped returning credits; aborting performance")
+            break
+    if not started:
+        await send_cmd(link, f"STREAM:START:{STREAM_LEAD_MS}")
+        start = time.time() + STREAM_LEAD_MS / 1000
+    await send_cmd(link, "STREAM:END")
+
+    pending = [f for f in futs if not f.done()]
+    if pending:
+        remaining = start + (playable[-1][0] if playable else 0) - time.time()
+        _, late = await asyncio.wait(pending, timeout=max(0, remaining) + 10.0)
+        for f in late:
+            f.cancel()
+        if late:
+            print(f"  [WARN] {len(late)} events never completed")
+    link.frames.clear()
+    link.credits = WINDOW
+
+    errors = sum(1 for f in futs if f.cancelled() or f.result().startswith("ERR"))
     if skipped:
         print(f"  [WARN] Skipped {skipped} events further right than Home (negative idx)")
+    if errors:
+        print(f"  [WARN] {errors} events failed or timed out")
+    if link.underruns:
+        print(f"  [WARN] Jitter buffer ran empty {link.underruns} times")
+    if link.late_log:
+        lates = sorted(link.late_log)
+        print(f"  Onset lateness: median={lates[len(lates)//2]}ms max={lates[-1]}ms "
+              f"(>20ms: {sum(1 for x in lates if x > 20)})")
+    print("=== Performance Finished ===\n")
+
+# ============================================================
+# SONG LIBRARY
+# ============================================================
+def compile_song(events):
+    """build_events() output -> flat bytes of fixed-size SONG_REC_FMT records."""
+    out = bytearray()
+    for t, rel, fingers, dur, budget, restrike in events:
+        if rel < 0:
+            continue
+        out += struct.pack(SONG_REC_FMT, int(round(t * 1000)), rel, finger_mask(fingers, restrike),
+                           to_ms16(dur), to_ms16(budget))
+    return bytes(out)
+
+def song_name(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return ''.join(c for c in stem if c.isalnum() or c in '-_')[:24] or "song"
+
+async def send_song_data(link, data):
+    """DATA frames for one upload attempt; returns their results. Raises
+    asyncio.TimeoutError if the ACKs stop coming (UPLOAD_ACK_TIMEOUT_S)."""
+    step = link.write_size - 3      # opcode + seq + crc
+    futs = []
+    for i in range(0, len(data), step):
+        futs.append(await submit_data(link, data[i:i+step], UPLOAD_ACK_TIMEOUT_S))
+    return await asyncio.wait_for(asyncio.gather(*futs), UPLOAD_ACK_TIMEOUT_S)
+
+async def upload_song(link, name, data):
+    """Bulk-transfer a compiled song to the device filesystem using DATA frames.
+    If the ACKs stop coming, the upload starts over, up to UPLOAD_TRIES times;
+    after that the partial file is deleted and False returned."""
+    for attempt in range(1, UPLOAD_TRIES + 1):
+        resp = await send_cmd(link, f"SONG:OPEN:{name}")
+        if resp is None or resp.startswith("ERR"):
+            print(f"  [WARN] SONG:OPEN -> {resp}")
+            return False
+        try:
+            results = await send_song_data(link, data)
+        except asyncio.TimeoutError:
+            print(f"  [WARN] Upload of '{name}' stalled: no ACK for {UPLOAD_ACK_TIMEOUT_S:.0f} s "
+                  f"(attempt {attempt}/{UPLOAD_TRIES})")
+            continue
+        finally:
+            link.frames.clear()
+            link.credits = WINDOW
+        break
+    else:
+        await send_cmd(link, "SONG:CLOSE")
+        await send_cmd(link, f"SONG:DEL:{name}")
+        print(f"  [ERROR] Upload of '{name}' failed, partial file deleted")
+        return False
+    failed = sum(1 for r in results if r.startswith("ERR"))
+    resp = await send_cmd(link, "SONG:CLOSE")
+    print(f"  Uploaded '{name}': {len(data)} bytes in {len(results)} frames -> {resp}")
+    if failed or resp != f"OK:SAVED={len(data)}":
+        print(f"  [WARN] Upload incomplete ({failed} frames failed)")
+        return False
+    return True
+
+async def perform_stored(link, name, events):
+    """Play a song from device flash; the link is idle until the DONE status."""
+    print(f"\n=== Stored Performance '{name}' ===")
+    link.status_event.clear()
+    resp = await send_cmd(link, f"SONG:PLAY:{name}")
+    if resp is None or resp.startswith("ERR"):
+        print(f"  [WARN] SONG:PLAY -> {resp}")
+        return
+    deadline = time.time() + (events[-1][0] if events else 0) + 30.0
+    while not (link.status or "").startswith("DONE"):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print("  [WARN] No DONE from device")
+            break
+        link.status_event.clear()
+        try:
+            await asyncio.wait_for(link.status_event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+    else:
+        print(f"  {link.status}")
     print("=== Performance Finished ===\n")
 
 # ============================================================
@@ -342,15 +765,17 @@ async def main():
 
     async with BleakClient(device) as client:
         print(f"  Connected: {device.address}")
+        link = PianoLink(client)
+        await link.start()
         await asyncio.sleep(0.5)
 
         # Stepper Calibration
-        home_key, signed_step = await calibrate_stepper(client, max_key)
+        home_key, signed_step = await calibrate_stepper(link, max_key)
 
         # Servo Calibration
         do_servo = (await ainput("\nProceed with Servo Calibration? [y/n]: ")).strip().lower()
         if do_servo == 'y':
-            await calibrate_servos(client)
+            await calibrate_servos(link)
 
         # Build Performance Events
         events = build_events(raw, home_key)
@@ -359,12 +784,22 @@ async def main():
         if min(rels) < 0:
             print("  [WARN] There are keys to the right of Home (rel_idx<0). Recommend setting Home further right.")
 
-        input_ = (await ainput("\nStart Performance? [Enter=Start, q=Quit]: ")).strip().lower()
+        input_ = (await ainput("\nStart Performance? [Enter=Start, s=Store on device and play, q=Quit]: ")).strip().lower()
         if input_ == 'q':
             return
+        stored = None
+        if input_ == 's':
+            name = song_name(CSV_PATH)
+            if await upload_song(link, name, compile_song(events)):
+                stored = name
 
         while True:
-            await perform(client, events, home_key)
+            if stored:
+                await perform_stored(link, stored, events)
+            elif STREAM_MODE:
+                await perform_stream(link, events, home_key)
+            else:
+                await perform(link, events, home_key)
             again = (await ainput("Play again? [y/n]: ")).strip().lower()
             if again != 'y':
                 break
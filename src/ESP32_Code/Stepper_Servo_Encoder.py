@@ -1,8 +1,17 @@
 from machine import Pin, PWM
 import time
 import math
+import gc
+import micropython
 import bluetooth
+from collections import deque
 from rotary_irq_esp import RotaryIRQ
+from stepgen import StepGen, TRAPEZOID
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
 
 # ==========================================
 # 1. Configuration & Hardware Dimensions
@@ -14,6 +23,7 @@ DIR_PIN_NUM  = 32
 STEP_PIN_NUM = 33
 ENC_CLK_PIN  = 12
 ENC_DT_PIN   = 13
+USE_PCNT     = True # Count encoder edges in the PCNT peripheral instead of pin IRQs (if the firmware has it)
 SERVO_PINS   = [14, 25, 26, 27, 15] 
 
 WHEEL_DIAMETER_IN = 3.11 # CHANGE
@@ -26,7 +36,12 @@ PULSES_PER_INCH = ENCODER_PPR / WHEEL_CIRCUMFERENCE_IN
 STEPS_PER_INCH = 200.0  
 
 TOLERANCE_IN = 0.04    
-STEP_DELAY_US = 300    
+
+# Step generator (RMT-timed, see stepgen.py). Rates in steps/s.
+STEP_RATE_START = 600   # jump-start speed
+STEP_RATE_MAX = 1667    # the old fixed rate (300 us half-period)
+STEP_ACCEL = 15000      # steps/s^2
+STEP_SHAPE = TRAPEZOID  # or SCURVE (import it too) for gentler starts
 
 MIN_US = 500
 MAX_US = 2500
@@ -38,22 +53,90 @@ NOTES = ("C","C#","D","D#","E","F","F#","G","G#","A","A#","B")
 # Adjust these to fine-tune your physical hardware movements
 TIME_SERVO_STRIKE = 0.7       # 1. Minimum time to wait for the servo to physically strike down
 TIME_SERVO_LIFT = 0.7         # 2. Minimum time to wait for the servo to rotate/lift back up
-TIME_CORRECTION_STALL = 0.75   # 3. Time to let physical momentum settle before reading the encoder
+TIME_SERVO_HOVER_LIFT = 0.15  # 3. Same, for a partial lift to hover height before a re-strike
+TIME_SERVO_STRIKE_FROM_HOVER = 0.2  # 4. Part of the strike time left once the finger is at hover height
+TIME_SERVO_TO_HOVER = TIME_SERVO_STRIKE - TIME_SERVO_STRIKE_FROM_HOVER
+
+# Per-finger hover angle, just above the key. The fingers of the next chord
+# are lowered to it while the hand travels, and re-striking fingers lift only
+# this far. Calibrate over BLE with "HOVER:a1,a2,a3,a4,a5"; "HOVER:" alone
+# reports the current values.
+HOVER_ANGLES = [60, 60, 60, 60, 60]
+
+# --- Position Controller ---
+# The encoder is sampled every CTRL_PERIOD_MS while the stepper runs; the
+# remaining step count is re-planned from the measured error, and the move is
+# done once the error AND speed have stayed inside their bands for
+# SETTLE_SAMPLES samples in a row. All of these can be changed over BLE with
+# "CTRL:KEY=VALUE[,KEY=VALUE...]"; "CTRL:" alone reports the current values.
+ctrl = {
+    "TOL": TOLERANCE_IN,   # arrival error band (in)
+    "VTOL": 0.5,           # arrival speed band (in/s)
+    "GAIN": 1.0,           # steps commanded per step of measured error
+    "PERIOD": 5,           # encoder sample period (ms)
+    "SETTLE": 3,           # consecutive in-band samples to declare arrival
+    "TIMEOUT": 3000,       # give up after this long (ms)
+}
+RETARGET_STEPS = 4      # ignore re-plans smaller than this (steps)
+
+# --- Executor ---
+# With USE_EXEC_THREAD the move/strike sequence runs on a second _thread and
+# the main thread sleeps and is left to BLE callbacks and the status writes
+# the executor schedules onto it. Jobs cross over through a lock-protected
+# queue. MicroPython threads on the ESP32 share one core and
+# the GIL, and GC stops both, so this keeps BLE work out of the middle of a
+# job rather than running the two in parallel. "STATS:" reports how long
+# jobs wait between arriving and starting, for comparing the two modes.
+USE_EXEC_THREAD = False   # off until STATS: on the rig shows it helps
+EXEC_STACK = 16 * 1024
+JOB_QUEUE_LEN = 4
+FRONT_IDLE_MS = 1000    # backstop flush, for when schedule() had no room
+
+# --- Memory ---
+# With PERF_MODE nothing is printed while a job runs, the VM does not
+# collect by itself mid-job (gc.threshold lifted), and the collection is
+# done during the lift wait at the end of the job instead. "MEM:" reports
+# free heap, largest block and GC count/time; "MEM:RESET" clears the counts.
+PERF_MODE = True
+GC_THRESHOLD_IDLE = 16 * 1024   # bytes allocated between collections outside a job
 
 # ==========================================
 # 2. Hardware Initialization
 # ==========================================
-dir_pin  = Pin(DIR_PIN_NUM, Pin.OUT, value=0)
-step_pin = Pin(STEP_PIN_NUM, Pin.OUT, value=0)
+stepper = StepGen(STEP_PIN_NUM, DIR_PIN_NUM, v_max=STEP_RATE_MAX, accel=STEP_ACCEL,
+                  v_start=STEP_RATE_START, shape=STEP_SHAPE)
 
-encoder = RotaryIRQ(pin_num_clk=ENC_CLK_PIN, pin_num_dt=ENC_DT_PIN, reverse=False, range_mode=RotaryIRQ.RANGE_UNBOUNDED)
+Encoder = RotaryIRQ
+if USE_PCNT:
+    try:
+        from rotary_pcnt_esp import RotaryPCNT as Encoder
+    except ImportError:     # esp32.PCNT is MicroPython v1.25+
+        print("No esp32.PCNT in this firmware, counting encoder edges with pin IRQs")
+encoder = Encoder(pin_num_clk=ENC_CLK_PIN, pin_num_dt=ENC_DT_PIN, reverse=False, range_mode=Encoder.RANGE_UNBOUNDED)
 fingers = [PWM(Pin(p), freq=50) for p in SERVO_PINS]
 
-job_pending = False
-target_distance_in = 0.0
-active_fingers = []
-finger_offsets = [0, 0, 0, 0, 0]
-max_duration = 0.0
+threaded = USE_EXEC_THREAD and _thread is not None
+jobs = deque((), JOB_QUEUE_LEN)   # (distance_in, fingers, offsets, duration, hover_after, received_ms)
+outbox = deque((), 8)             # status strings for the main thread (threaded mode)
+tx_pending = False                # flush_outbox() already scheduled
+if threaded:
+    jobs_lock = _thread.allocate_lock()
+    job_ready = _thread.allocate_lock()     # held while there is nothing to do
+    job_ready.acquire()
+    main_thread = _thread.get_ident()
+
+start_delay = 0         # ms from receiving the last job to starting it
+start_delay_max = 0
+start_delay_sum = 0
+start_count = 0
+
+job_running = False
+mem_req = False         # MEM: asked; the executor answers when idle
+gc_count = 0            # collections run by gc_run()
+gc_us = 0               # duration of the last one
+gc_us_max = 0
+gc_us_sum = 0
+gc.threshold(GC_THRESHOLD_IDLE)
 
 # ==========================================
 # 3. Helper Functions
@@ -78,22 +161,144 @@ def parse_note(note_str):
 def get_current_in():
     return encoder.value() / PULSES_PER_INCH
 
-def move_stepper_relative(dist_in):
+def seek(target_in):
+    """Closed-loop move to an absolute encoder position (inches).
+    Returns (final error in inches, ms taken, correction moves)."""
+    t0 = time.ticks_ms()
+    period = int(ctrl["PERIOD"])
+    last = encoder.value()
+    last_t = time.ticks_us()
+    settled = 0
+    moves = 0
+    move_stepper_relative(target_in - last / PULSES_PER_INCH, wait=False)
+    while True:
+        time.sleep_ms(period)
+        count = encoder.value()
+        now = time.ticks_us()
+        dt = time.ticks_diff(now, last_t) / 1000000
+        vel_in = (count - last) / PULSES_PER_INCH / dt if dt > 0 else 0.0
+        last, last_t = count, now
+        error_in = target_in - count / PULSES_PER_INCH
+        want = int(error_in * STEPS_PER_INCH * ctrl["GAIN"])
+
+        if stepper.busy():
+            settled = 0
+            if want * stepper.direction() <= 0:
+                stepper.stop()          # overshot: reverse from standstill
+            elif abs(abs(want) - stepper.remaining()) >= RETARGET_STEPS:
+                stepper.retarget(abs(want))
+        elif abs(error_in) <= ctrl["TOL"] and abs(vel_in) <= ctrl["VTOL"]:
+            settled += 1
+            if settled >= ctrl["SETTLE"]:
+                break
+        elif abs(error_in) > ctrl["TOL"] and abs(vel_in) <= ctrl["VTOL"]:
+            settled = 0
+            moves += 1
+            move_stepper_relative(error_in, wait=False)
+        else:
+            settled = 0
+
+        if time.ticks_diff(time.ticks_ms(), t0) > ctrl["TIMEOUT"]:
+            stepper.stop()
+            print("[WARN] seek timed out")
+            break
+    return error_in, time.ticks_diff(time.ticks_ms(), t0), moves
+
+def move_stepper_relative(dist_in, wait=True):
     if abs(dist_in) < 0.005: return
         
     steps = int(abs(dist_in) * STEPS_PER_INCH)
-    dir_pin.value(1 if dist_in > 0 else 0)
-
-    for i in range(steps):
-        step_pin.value(1)
-        time.sleep_us(STEP_DELAY_US)
-        step_pin.value(0)
-        time.sleep_us(STEP_DELAY_US)
+    stepper.move(steps if dist_in > 0 else -steps)
+    if wait:
+        stepper.wait()
 
 def set_status(status_str):
     """Updates the BLE characteristic so the PC knows the current state"""
+    global tx_pending
+    if threaded and _thread.get_ident() != main_thread:
+        with jobs_lock:
+            outbox.append(status_str)
+        # Scheduled callbacks run on the main thread, which wakes for them.
+        if not tx_pending:
+            tx_pending = True
+            try:
+                micropython.schedule(flush_outbox, None)
+            except RuntimeError:
+                tx_pending = False
+        return
     ble.gatts_write(CHAR_HANDLE, status_str.encode('utf-8'))
 
+def flush_outbox(_=None):
+    global tx_pending
+    tx_pending = False
+    while outbox:
+        with jobs_lock:
+            status_str = outbox.popleft()
+        ble.gatts_write(CHAR_HANDLE, status_str.encode('utf-8'))
+
+def put_job(job):
+    if not threaded:
+        jobs.append(job)
+        return
+    with jobs_lock:
+        jobs.append(job)
+    if job_ready.locked():
+        job_ready.release()
+
+def take_job():
+    if not threaded:
+        return jobs.popleft() if jobs else None
+    with jobs_lock:
+        return jobs.popleft() if jobs else None
+
+def gc_run():
+    global gc_count, gc_us, gc_us_max, gc_us_sum
+    t0 = time.ticks_us()
+    gc.collect()
+    gc_us = time.ticks_diff(time.ticks_us(), t0)
+    gc_us_max = max(gc_us_max, gc_us)
+    gc_us_sum += gc_us
+    gc_count += 1
+
+def largest_block():
+    """Largest bytearray the heap can hold, by bisection. Every miss forces a
+    collection, so only the idle executor calls it (mem_report)."""
+    lo, hi = 0, gc.mem_free()
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        try:
+            b = bytearray(mid)
+            lo = mid
+        except MemoryError:
+            hi = mid - 1
+        b = None
+    gc.collect()    # not gc_run(): keep the probe out of the GC figures
+    return lo
+
+def mem_report():
+    global mem_req
+    mem_req = False
+    set_status("MEM:FREE=%d,ALLOC=%d,MAXBLK=%d,GC=%d,GCUS=%d/%d/%d,PERF=%s" % (
+        gc.mem_free(), gc.mem_alloc(), largest_block(),
+        gc_count, gc_us, gc_us_max, gc_us_sum // max(1, gc_count),
+        "ON" if PERF_MODE else "OFF"))
+
+def idle_wait(seconds):
+    """Sleep while nothing needs the CPU; in PERF_MODE collect first."""
+    t0 = time.ticks_ms()
+    if PERF_MODE:
+        gc_run()
+    left = seconds - time.ticks_diff(time.ticks_ms(), t0) / 1000
+    if left > 0:
+        time.sleep(left)
+
+def note_start(received_ms):
+    global start_delay, start_delay_max, start_delay_sum, start_count
+    start_delay = time.ticks_diff(time.ticks_ms(), received_ms)
+    start_delay_max = max(start_delay_max, start_delay)
+    start_delay_sum += start_delay
+    start_count += 1
+
 print("Initializing servos...")
 for f in fingers:
     set_angle(f, 180)
@@ -109,16 +314,58 @@ ble.active(True)
 ((CHAR_HANDLE,),) = ble.gatts_register_services(((SERVICE_UUID, ((CHAR_UUID, bluetooth.FLAG_WRITE | bluetooth.FLAG_READ),)),))
 
 def on_rx(v: bytes):
-    global job_pending, target_distance_in, active_fingers, finger_offsets, max_duration
+    global start_delay, start_delay_max, start_delay_sum, start_count
+    global gc_count, gc_us, gc_us_max, gc_us_sum, mem_req
+    received_ms = time.ticks_ms()
     try:
         cmd = v.decode("utf-8").strip()
         
         if cmd in ["READY", "BUSY"]: return 
+
+        if cmd.startswith("CTRL:"):
+            for item in cmd[5:].split(","):
+                if "=" in item:
+                    k, v = item.split("=")
+                    k = k.strip().upper()
+                    if k in ctrl:
+                        ctrl[k] = float(v)
+            set_status("CTRL:" + ",".join("%s=%g" % (k, ctrl[k]) for k in ctrl))
+            return
+
+        if cmd.startswith("HOVER:"):
+            angles = [int(x) for x in cmd[6:].split(",") if x.strip()]
+            if len(angles) == 5:
+                HOVER_ANGLES[:] = angles
+            set_status("HOVER:" + ",".join(str(a) for a in HOVER_ANGLES))
+            return
+
+        if cmd.startswith("STATS:"):
+            avg = start_delay_sum // start_count if start_count else 0
+            set_status("STATS:DELAY=%d/%d/%d,N=%d,EXEC=%s" % (
+                start_delay, start_delay_max, avg, start_count,
+                "THREAD" if threaded else "LOOP"))
+            if cmd[6:].strip().upper() == "RESET":
+                start_delay = start_delay_max = start_delay_sum = start_count = 0
+            return
+
+        if cmd.startswith("MEM:"):
+            # Answered by the executor once it has no job (mem_report).
+            if cmd[4:].strip().upper() == "RESET":
+                gc_count = gc_us = gc_us_max = gc_us_sum = 0
+            mem_req = True
+            if threaded and job_ready.locked():
+                job_ready.release()
+            return
         
-        print(f"\nReceived Command: {cmd}")
+        if not PERF_MODE:
+            print(f"\nReceived Command: {cmd}")
         set_status("BUSY") 
         
-        move_part, play_part = cmd.split("|")
+        # Optional third field "H<f>;<f>...": the next command stays on this
+        # key and re-strikes these fingers, so they only lift to hover height.
+        fields = cmd.split("|")
+        move_part, play_part = fields[0], fields[1]
+        restrike = fields[2][1:] if len(fields) > 2 and fields[2].startswith("H") else ""
         
         # 1. Parse Move
         m_parts = move_part.split(",")
@@ -126,7 +373,7 @@ def on_rx(v: bytes):
         e_idx = parse_note(m_parts[1])
         finger_offsets = [int(x) for x in m_parts[2:7]]
         
-        target_distance_in = (e_idx - s_idx) * INCHES_PER_NOTE
+        distance_in = (e_idx - s_idx) * INCHES_PER_NOTE
         
         # 2. Parse Play
         active_fingers = []
@@ -135,8 +382,10 @@ def on_rx(v: bytes):
             f_num, dur = chord_part.split(",")
             active_fingers.append(int(f_num))
             max_duration = max(max_duration, float(dur)) 
-            
-        job_pending = True
+        restrike = [int(x) for x in restrike.split(";") if x.strip()]
+        hover_after = [f for f in active_fingers if f in restrike]
+        put_job((distance_in, active_fingers, finger_offsets, max_duration,
+                 hover_after, received_ms))
         
     except Exception as e:
         print("RX Error:", e)
@@ -165,54 +414,90 @@ set_status("READY")
 advertise()
 
 # ==========================================
-# 5. Main Loop (Execution & Correction)
+# 5. Executor (Execution & Correction)
 # ==========================================
-print("System Ready. Waiting for commands...")
+def run_job(job):
+    global job_running
+    target_distance_in, active_fingers, finger_offsets, max_duration, hover_after, received_ms = job
+    note_start(received_ms)
+    job_running = True
+    if PERF_MODE:
+        gc.threshold(-1)    # only if the heap actually fills
 
-while True:
-    if job_pending:
-        # --- 1. Move Stepper ---
-        initial_in = get_current_in()
-        absolute_target_in = initial_in + target_distance_in
-        move_stepper_relative(target_distance_in)
-        
-        # --- 2. Correction Loop ---
-        time.sleep(TIME_CORRECTION_STALL) 
-        current_in = get_current_in()
-        error_in = absolute_target_in - current_in
-        
-        while abs(error_in) > TOLERANCE_IN:
-            move_stepper_relative(error_in)
-            time.sleep(TIME_CORRECTION_STALL) 
-            current_in = get_current_in()
-            error_in = absolute_target_in - current_in
-            
-        # --- 3. Strike Key(s) ---
+    # --- 0. Pre-strike hover ---
+    # Lower the chord's fingers to hover height now, so the servo travel
+    # overlaps the hand's travel and only the short final drop is left.
+    for f_idx in active_fingers:
+        if 1 <= f_idx <= 5:
+            set_angle(fingers[f_idx - 1], HOVER_ANGLES[f_idx - 1])
+    hover_start = time.ticks_ms()
+
+    # --- 1+2. Move Stepper under encoder feedback ---
+    initial_in = get_current_in()
+    absolute_target_in = initial_in + target_distance_in
+    if abs(target_distance_in) >= 0.005:
+        error_in, took_ms, fixes = seek(absolute_target_in)
+        if not PERF_MODE:
+            print(f"Arrived: err={error_in:+.3f}in in {took_ms}ms ({fixes} corrections)")
+
+    # --- 3. Strike Key(s) ---
+    if not PERF_MODE:
         print(f"Striking fingers: {active_fingers}")
-        for f_idx in active_fingers:
-            if 1 <= f_idx <= 5:
-                servo = fingers[f_idx - 1]
-                offset = finger_offsets[f_idx - 1]
-                
-                # Base strike angle is 15. Flat (-15) pushes it to 0. Sharp (+15) raises it to 30.
-                strike_angle = 15 + offset 
-                set_angle(servo, strike_angle)
-                
-        # Wait for the longer duration: either the text file's note length, or the physical minimum strike time
-        time.sleep(max(max_duration, TIME_SERVO_STRIKE))
-        
-        # --- 4. Lift Key(s) ---
-        for f_idx in active_fingers:
-            if 1 <= f_idx <= 5:
-                servo = fingers[f_idx - 1]
-                set_angle(servo, 180) 
-                
-        time.sleep(TIME_SERVO_LIFT) # Wait for physical lift clearance
-        
-        # --- 5. Clean up and signal PC ---
-        job_pending = False
-        set_status("READY")
-        print("Ready for next command.")
+    for f_idx in active_fingers:
+        if 1 <= f_idx <= 5:
+            servo = fingers[f_idx - 1]
+            offset = finger_offsets[f_idx - 1]
+
+            # Base strike angle is 15. Flat (-15) pushes it to 0. Sharp (+15) raises it to 30.
+            strike_angle = 15 + offset
+            set_angle(servo, strike_angle)
+
+    # Wait for the longer duration: either the text file's note length, or the physical
+    # strike time from hover (plus whatever of the hover descent the move did not cover)
+    hovered = time.ticks_diff(time.ticks_ms(), hover_start) / 1000
+    strike_time = TIME_SERVO_STRIKE_FROM_HOVER + max(0.0, TIME_SERVO_TO_HOVER - hovered)
+    time.sleep(max(max_duration, strike_time))
 
+    # --- 4. Lift Key(s) ---
+    # Fingers that re-strike next only rise to hover height, which is a
+    # much shorter trip both ways. The others lift fully, but the hand stays
+    # on this key, so nothing has to clear it before the next command.
+    for f_idx in active_fingers:
+        if 1 <= f_idx <= 5:
+            servo = fingers[f_idx - 1]
+            set_angle(servo, HOVER_ANGLES[f_idx - 1] if f_idx in hover_after else 180)
+
+    if hover_after:
+        idle_wait(TIME_SERVO_HOVER_LIFT)
     else:
-        time.sleep_ms(20)
+        idle_wait(TIME_SERVO_LIFT) # Wait for physical lift clearance
+
+    # --- 5. Clean up and signal PC ---
+    gc.threshold(GC_THRESHOLD_IDLE)
+    job_running = False
+    set_status("READY")
+    if not PERF_MODE:
+        print("Ready for next command.")
+
+def executor():
+    while True:
+        job = take_job()
+        if job is not None:
+            run_job(job)
+        elif mem_req:
+            mem_report()
+        elif threaded:
+            job_ready.acquire()     # sleeps until put_job() releases it
+        else:
+            time.sleep_ms(20)
+
+print("System Ready. Waiting for commands...")
+
+if threaded:
+    _thread.stack_size(EXEC_STACK)
+    _thread.start_new_thread(executor, ())
+    while True:
+        time.sleep_ms(FRONT_IDLE_MS)
+        flush_outbox()
+else:
+    executor()
@@ -0,0 +1,115 @@
+# Host benchmark for the Rotary IRQ handlers (runs under CPython).
+#
+#   python bench_rotary.py [edges]
+#
+# machine.Pin and micropython are mocked, so the figures are for CPython on
+# this machine, not the ESP32; use them to compare the handlers with each
+# other. Also checks that the count comes out right and that a skipped edge
+# shows up in the illegal-transition counter.
+
+import builtins
+import sys
+import time
+import types
+
+builtins.const = lambda x: x
+
+
+class _Pin(object):
+    IN = 0
+    PULL_UP = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, num, mode=None, pull=None):
+        self.v = 1
+
+    def value(self, v=None):
+        if v is not None:
+            self.v = v
+        return self.v
+
+    def irq(self, trigger=None, handler=None):
+        pass
+
+
+_sched = []
+
+
+def _schedule(fn, arg):
+    if len(_sched) >= 8:        # MicroPython's default schedule queue depth
+        raise RuntimeError("schedule queue full")
+    _sched.append((fn, arg))
+
+
+machine = types.ModuleType("machine")
+machine.Pin = _Pin
+sys.modules["machine"] = machine
+micropython = types.ModuleType("micropython")
+micropython.native = lambda f: f
+micropython.schedule = _schedule
+sys.modules["micropython"] = micropython
+
+from rotary import Rotary                   # noqa: E402
+from rotary_irq_esp import RotaryIRQ        # noqa: E402
+
+# Full-step CW cycle from rest (CLK=1, DT=1); each entry is one edge.
+CW_CYCLE = ((1, 0), (0, 0), (0, 1), (1, 1))
+
+
+def run(r, edges, listener=False, drain_every=0):
+    hits = [0]
+    if listener:
+        r.add_listener(lambda: hits.__setitem__(0, hits[0] + 1))
+    handler = r._irq_handler()
+    clk, dt = r._pin_clk, r._pin_dt
+    seq = [CW_CYCLE[i % 4] for i in range(edges)]
+    del _sched[:]
+    t0 = time.perf_counter()
+    for i, (c, d) in enumerate(seq):
+        clk.v = c
+        dt.v = d
+        handler(clk)
+        if drain_every and i % drain_every == 0:
+            while _sched:
+                fn, arg = _sched.pop(0)
+                fn(arg)
+    elapsed = time.perf_counter() - t0
+    while _sched:
+        fn, arg = _sched.pop(0)
+        fn(arg)
+    return edges / elapsed, hits[0]
+
+
+def make(range_mode):
+    return RotaryIRQ(pin_num_clk=1, pin_num_dt=2, min_val=0, max_val=1 << 30,
+                     range_mode=range_mode)
+
+
+def main():
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print("%d edges per run" % edges)
+    for name, mode in (("unbounded (fast path)", Rotary.RANGE_UNBOUNDED),
+                       ("bounded   (generic)", Rotary.RANGE_BOUNDED),
+                       ("wrap      (generic)", Rotary.RANGE_WRAP)):
+        r = make(mode)
+        rate, _ = run(r, edges)
+        assert r.value() == (edges // 4) % (r._max_val + 1), r.value()
+        print("  %-22s %9.0f edges/s" % (name, rate))
+
+    r = make(Rotary.RANGE_UNBOUNDED)
+    rate, hits = run(r, edges, listener=True, drain_every=64)
+    print("  %-22s %9.0f edges/s  (%d listener runs for %d counts, %d dropped)" %
+          ("unbounded + listener", rate, hits, r.value(), r.counters()[1]))
+
+    # Skip one edge (00 -> 11): the count is lost, but no longer silently.
+    r = make(Rotary.RANGE_UNBOUNDED)
+    h = r._irq_handler()
+    for c, d in ((1, 0), (0, 0), (1, 1)):
+        r._pin_clk.v, r._pin_dt.v = c, d
+        h(r._pin_clk)
+    print("  skipped edge: value=%d illegal=%d" % (r.value(), r.counters()[0]))
+
+
+if __name__ == "__main__":
+    main()
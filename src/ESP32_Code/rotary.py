@@ -50,6 +50,16 @@ _STATE_MASK = const(0x07)
 _DIR_MASK = const(0x30)
 
 
+# Flat copies of the tables above, indexed by (state << 2) | clk_dt_pins:
+# one bytes lookup in the IRQ instead of two list indexes.
+def _flatten(table):
+    return bytes([next_state for row in table for next_state in row])
+
+
+_transition_bytes = _flatten(_transition_table)
+_transition_bytes_half_step = _flatten(_transition_table_half_step)
+
+
 def _wrap(value, incr, lower_bound, upper_bound):
     range = upper_bound - lower_bound + 1
     value = value + incr
@@ -65,6 +75,7 @@ def _bound(value, incr, lower_bound, upper_bound):
 
 
 def _trigger(rotary_instance):
+    rotary_instance._trigger_pending = False
     for listener in rotary_instance._listener:
         listener()
 
@@ -86,6 +97,27 @@ class Rotary(object):
         self._half_step = half_step
         self._invert = invert
         self._listener = []
+        self._target = 0
+        self._target_dir = 0      # 0 = disarmed, 1 = fire at >= target, -1 = fire at <= target
+        self._target_hit = False
+        self._target_cb = None
+        self._pins = 0
+        self._illegal = 0           # edges where both pins changed at once (a count was lost)
+        self._overflow = 0          # listener dispatches dropped: schedule queue full
+        self._trigger_pending = False
+        self._update_cache()
+
+    def _update_cache(self):
+        # Everything the IRQ handler needs, precomputed so it does no
+        # arithmetic on configuration and no attribute chains.
+        self._table = _transition_bytes_half_step if self._half_step else _transition_bytes
+        self._step = self._incr * self._reverse
+        self._invert_mask = 0x03 if self._invert else 0x00
+
+    def _irq_handler(self):
+        if self._range_mode == self.RANGE_UNBOUNDED:
+            return self._process_rotary_pins_unbounded
+        return self._process_rotary_pins
 
     def set(self, value=None, min_val=None, incr=None,
             max_val=None, reverse=None, range_mode=None):
@@ -105,6 +137,7 @@ class Rotary(object):
         if range_mode is not None:
             self._range_mode = range_mode
         self._state = _R_START
+        self._update_cache()
 
         # enable DT and CLK pin interrupts
         self._hal_enable_irq()
@@ -125,31 +158,85 @@ class Rotary(object):
         if l not in self._listener:
             raise ValueError('{} is not an installed listener'.format(l))
         self._listener.remove(l)
+
+    def arm_target(self, target, callback=None):
+        # Fire once when the count reaches or crosses target, in the direction
+        # it has to travel from the current value. callback runs in the pin
+        # IRQ handler, so keep it short (e.g. retarget a pulse generator).
+        self._target_hit = False
+        self._target_cb = callback
+        self._target = target
+        value = self.value()
+        if target == value:
+            self._target_dir = 0
+            self._target_hit = True
+            if callback is not None:
+                callback()
+        else:
+            self._target_dir = 1 if target > value else -1
+
+    def disarm_target(self):
+        self._target_dir = 0
+
+    def target_reached(self):
+        return self._target_hit
+
+    def counters(self):
+        # (illegal transitions, dropped listener dispatches) since start
+        return self._illegal, self._overflow
+
+    def _schedule_trigger(self):
+        # Listeners run outside the IRQ via micropython.schedule; edges that
+        # arrive before they have run are folded into the pending call.
+        if self._trigger_pending:
+            return
+        try:
+            micropython.schedule(_trigger, self)
+            self._trigger_pending = True
+        except RuntimeError:
+            self._overflow += 1
+
+    @micropython.native
+    def _process_rotary_pins_unbounded(self, pin):
+        # Fast path for RANGE_UNBOUNDED: no range branch, no allocation.
+        pins = ((self._clk_read() << 1) | self._dt_read()) ^ self._invert_mask
+        if (pins ^ self._pins) == 0x03:
+            self._illegal += 1
+        self._pins = pins
+        state = self._table[((self._state & _STATE_MASK) << 2) | pins]
+        self._state = state
+        direction = state & _DIR_MASK
+        if direction == 0:
+            return
+        if direction == _DIR_CW:
+            self._value += self._step
+        else:
+            self._value -= self._step
+        if self._target_dir != 0:
+            if (self._value - self._target) * self._target_dir >= 0:
+                self._target_dir = 0
+                self._target_hit = True
+                if self._target_cb is not None:
+                    self._target_cb()
+        if self._listener:
+            self._schedule_trigger()
         
     def _process_rotary_pins(self, pin):
         old_value = self._value
-        clk_dt_pins = (self._hal_get_clk_value() <<
-                       1) | self._hal_get_dt_value()
-                       
-        if self._invert:
-            clk_dt_pins = ~clk_dt_pins & 0x03
-            
+        pins = ((self._hal_get_clk_value() << 1) | self._hal_get_dt_value()) ^ self._invert_mask
+        if (pins ^ self._pins) == 0x03:
+            self._illegal += 1
+        self._pins = pins
+
         # Determine next state
-        if self._half_step:
-            self._state = _transition_table_half_step[self._state &
-                                                      _STATE_MASK][clk_dt_pins]
-        else:
-            self._state = _transition_table[self._state &
-                                            _STATE_MASK][clk_dt_pins]
+        self._state = self._table[((self._state & _STATE_MASK) << 2) | pins]
         direction = self._state & _DIR_MASK
 
         incr = 0
         if direction == _DIR_CW:
-            incr = self._incr
+            incr = self._step
         elif direction == _DIR_CCW:
-            incr = -self._incr
-
-        incr *= self._reverse
+            incr = -self._step
 
         if self._range_mode == self.RANGE_WRAP:
             self._value = _wrap(
@@ -166,8 +253,12 @@ class Rotary(object):
         else:
             self._value = self._value + incr
 
-        try:
-            if old_value != self._value and len(self._listener) != 0:
-                _trigger(self)
-        except:
-            pass
\ No newline at end of file
+        if self._target_dir != 0 and incr != 0:
+            if (self._value - self._target) * self._target_dir >= 0:
+                self._target_dir = 0
+                self._target_hit = True
+                if self._target_cb is not None:
+                    self._target_cb()
+
+        if old_value != self._value and self._listener:
+            self._schedule_trigger()
\ No newline at end of file
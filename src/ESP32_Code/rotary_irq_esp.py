@@ -39,8 +39,11 @@ class RotaryIRQ(Rotary):
             self._pin_clk = Pin(pin_num_clk, Pin.IN)
             self._pin_dt = Pin(pin_num_dt, Pin.IN)
 
-        self._enable_clk_irq(self._process_rotary_pins)
-        self._enable_dt_irq(self._process_rotary_pins)
+        # Bound once so the IRQ handler calls them without a lookup chain
+        self._clk_read = self._pin_clk.value
+        self._dt_read = self._pin_dt.value
+
+        self._hal_enable_irq()
 
     def _enable_clk_irq(self, callback=None):
         self._pin_clk.irq(
@@ -65,8 +68,10 @@ class RotaryIRQ(Rotary):
         return self._pin_dt.value()
 
     def _hal_enable_irq(self):
-        self._enable_clk_irq(self._process_rotary_pins)
-        self._enable_dt_irq(self._process_rotary_pins)
+        self._pins = ((self._pin_clk.value() << 1) | self._pin_dt.value()) ^ self._invert_mask
+        handler = self._irq_handler()
+        self._enable_clk_irq(handler)
+        self._enable_dt_irq(handler)
 
     def _hal_disable_irq(self):
         self._disable_clk_irq()
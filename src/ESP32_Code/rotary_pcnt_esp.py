@@ -0,0 +1,184 @@
+# Platform-specific MicroPython code for the rotary encoder module
+# ESP32 implementation backed by the PCNT (pulse counter) peripheral
+#
+# Drop-in alternative to RotaryIRQ: same value() / set() / reset() /
+# listener / arm_target() API, but the quadrature edges are counted in
+# hardware, so the CPU is not interrupted per edge at any shaft speed.
+# Needs a MicroPython build with esp32.PCNT (v1.25+).
+#
+# - The hardware counter is 16-bit. It is folded into a Python int each
+#   time it reaches +/-_LIMIT (one IRQ per 32000 edges), so value() is
+#   effectively unbounded.
+# - arm_target() programs a PCNT watch point (threshold0), so the
+#   comparator costs nothing until it fires.
+# - Listeners are polled from a machine.Timer every listener_poll_ms while
+#   any are installed, instead of running on every edge.
+# - RANGE_WRAP / RANGE_BOUNDED are applied when value() is read.
+
+from machine import Pin, Timer
+from esp32 import PCNT
+from rotary import Rotary
+
+_LIMIT = const(32000)
+
+
+class RotaryPCNT(Rotary):
+
+    def __init__(self, pin_num_clk, pin_num_dt, min_val=0, max_val=10, incr=1,
+                 reverse=False, range_mode=Rotary.RANGE_UNBOUNDED, pull_up=False, half_step=False,
+                 invert=False, unit=0, filter_ns=1000, listener_poll_ms=10, timer_id=1):
+
+        super().__init__(min_val, max_val, incr, reverse, range_mode, half_step, invert)
+
+        pull = Pin.PULL_UP if pull_up else None
+        self._pin_clk = Pin(pin_num_clk, Pin.IN, pull)
+        self._pin_dt = Pin(pin_num_dt, Pin.IN, pull)
+
+        # Edges per count, matching the software decoder: a full quadrature
+        # cycle per count, or half of one in half-step mode. (Inverting both
+        # signals does not change the edge count, so `invert` needs nothing.)
+        self._edges = 2 if half_step else 4
+        self._acc = 0           # edges folded in from counter overflows
+        self._last_raw = 0      # last _raw() result, to spot an unfolded overflow
+        self._raw0 = 0          # raw edge count at which value() == self._value
+        self._last = min_val
+        self._poll_ms = listener_poll_ms
+        self._timer = Timer(timer_id)
+
+        # 4x quadrature: each channel counts both edges of one signal, with
+        # the direction taken from the level of the other.
+        self._pcnt = PCNT(unit, min=-_LIMIT, max=_LIMIT, filter=filter_ns)
+        self._pcnt.init(channel=0, pin=self._pin_clk, falling=PCNT.INCREMENT,
+                        rising=PCNT.DECREMENT, mode_pin=self._pin_dt, mode_low=PCNT.REVERSE)
+        self._pcnt.init(channel=1, pin=self._pin_dt, falling=PCNT.DECREMENT,
+                        rising=PCNT.INCREMENT, mode_pin=self._pin_clk, mode_low=PCNT.REVERSE)
+        self._pcnt.irq(handler=self._on_pcnt,
+                       trigger=PCNT.IRQ_MIN | PCNT.IRQ_MAX | PCNT.IRQ_THRESHOLD0)
+        self._pcnt.value(0)
+        self._pcnt.start()
+
+    # ---------- counting ----------
+
+    def _raw(self):
+        # An overflow IRQ can land between the two reads; retry if it did.
+        while True:
+            acc = self._acc
+            count = self._pcnt.value()
+            if acc == self._acc:
+                break
+        raw = acc + count
+        # The unit is back at 0 the moment it hits a limit, but _acc is only
+        # bumped once the (soft) IRQ handler runs. A reading in between is
+        # _LIMIT off, which shows up as a jump of more than half that since
+        # the last reading. (A real move of over _LIMIT/2 edges between two
+        # readings would be taken for one; value() is read far more often
+        # than that while the shaft turns.)
+        d = raw - self._last_raw
+        if d > _LIMIT // 2:
+            raw -= _LIMIT
+        elif d < -(_LIMIT // 2):
+            raw += _LIMIT
+        self._last_raw = raw
+        return raw
+
+    def value(self):
+        d = self._raw() - self._raw0
+        counts = d // self._edges if d >= 0 else -((-d) // self._edges)
+        v = self._value + counts * self._step
+        if self._range_mode == self.RANGE_WRAP:
+            span = self._max_val - self._min_val + 1
+            return self._min_val + (v - self._min_val) % span
+        if self._range_mode == self.RANGE_BOUNDED:
+            if v > self._max_val or v < self._min_val:
+                # Stick at the bound: turning back moves off it at once,
+                # like the software decoder.
+                v = min(self._max_val, max(self._min_val, v))
+                self._value = v
+                self._raw0 = self._raw()
+        return v
+
+    def set(self, value=None, min_val=None, incr=None,
+            max_val=None, reverse=None, range_mode=None):
+        # Fold the counts so far into the base before changing the scaling.
+        self._value = self.value()
+        self._raw0 = self._raw()
+        super().set(value, min_val, incr, max_val, reverse, range_mode)
+        self._update_watch()
+
+    def reset(self):
+        self._value = 0
+        self._raw0 = self._raw()
+        self._update_watch()
+
+    # ---------- IRQ / watch point ----------
+
+    def _on_pcnt(self, pcnt):
+        flags = pcnt.irq().flags()
+        # The unit resets to zero when it hits a limit.
+        if flags & PCNT.IRQ_MAX:
+            self._acc += _LIMIT
+        if flags & PCNT.IRQ_MIN:
+            self._acc -= _LIMIT
+        if self._target_dir != 0:
+            if (self.value() - self._target) * self._target_dir >= 0:
+                self._target_dir = 0
+                self._target_hit = True
+                if self._target_cb is not None:
+                    self._target_cb()
+            elif flags & (PCNT.IRQ_MAX | PCNT.IRQ_MIN):
+                self._update_watch()
+
+    def _update_watch(self):
+        # Put threshold0 on the raw edge count where the armed target is
+        # reached, if it falls inside the current 16-bit window; otherwise
+        # the next overflow IRQ tries again.
+        if self._target_dir == 0:
+            return
+        counts = (self._target - self._value) // self._step
+        count = self._pcnt.value()
+        at = self._raw0 + counts * self._edges - self._acc - count
+        if -_LIMIT < at < _LIMIT:
+            # Reconfiguring the unit can clear it: fold the count into _acc
+            # and restart from 0 so the threshold is relative to that. (An
+            # overflow IRQ still pending adds its _LIMIT after this, and then
+            # calls back in here.)
+            self._acc += count
+            self._pcnt.init(threshold0=at)
+            self._pcnt.value(0)
+            self._pcnt.start()
+
+    def arm_target(self, target, callback=None):
+        super().arm_target(target, callback)
+        self._update_watch()
+
+    # ---------- listeners ----------
+
+    def _poll(self, _timer):
+        v = self.value()
+        if v != self._last:
+            self._last = v
+            self._schedule_trigger()
+
+    def add_listener(self, l):
+        super().add_listener(l)
+        if len(self._listener) == 1:
+            self._last = self.value()
+            self._timer.init(mode=Timer.PERIODIC, period=self._poll_ms, callback=self._poll)
+
+    def remove_listener(self, l):
+        super().remove_listener(l)
+        if not self._listener:
+            self._timer.deinit()
+
+    # ---------- HAL hooks used by Rotary.set() ----------
+
+    def _hal_enable_irq(self):
+        pass
+
+    def _hal_disable_irq(self):
+        pass
+
+    def _hal_close(self):
+        self._timer.deinit()
+        self._pcnt.irq(handler=None)
+        self._pcnt.deinit()
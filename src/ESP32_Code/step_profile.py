@@ -0,0 +1,85 @@
+# Step-interval profiles for STEP/DIR stepper drivers.
+#
+# Pure Python (no machine imports) so the same code runs under MicroPython
+# on the ESP32 and under CPython on the host:
+#   python step_profile.py 400 3000 15000
+#
+# Speeds are in steps/s, acceleration in steps/s^2. Velocity is planned
+# against position rather than time: every step looks at how far it is from
+# the start (ramp up) and from the end (ramp down), so the remaining step
+# count can be changed mid-move (retarget) without replanning.
+
+import math
+
+TRAPEZOID = 0   # constant acceleration, instant jerk at the ramp ends
+SCURVE = 1      # raised-cosine ramp, acceleration starts and ends at zero
+
+
+class Profile(object):
+
+    def __init__(self, steps, v_max, accel, v_start=0, shape=TRAPEZOID):
+        self.v_max = float(v_max)
+        self.accel = float(accel)
+        self.v_start = float(min(v_start, v_max))
+        self.shape = shape
+        self.done = 0               # steps already handed out
+        self.remaining = abs(int(steps))
+        # Ramp length in steps. For the S-curve, shaping v^2 with a raised
+        # cosine over pi/2 times the trapezoid ramp gives the same peak
+        # acceleration.
+        span = self.v_max * self.v_max - self.v_start * self.v_start
+        self._span = span
+        self._ramp = span / (2.0 * self.accel)
+        if shape == SCURVE:
+            self._ramp *= math.pi / 2
+
+    def _v_at(self, n):
+        """Speed allowed n steps away from a standstill end of the move."""
+        if n >= self._ramp:
+            return self.v_max
+        v0sq = self.v_start * self.v_start
+        if self.shape == SCURVE:
+            vsq = v0sq + self._span * (1 - math.cos(math.pi * n / self._ramp)) / 2
+        else:
+            vsq = v0sq + 2.0 * self.accel * n
+        # Never plan a zero speed: the first/last step still has to happen.
+        return max(math.sqrt(vsq), self.v_start, math.sqrt(2.0 * self.accel))
+
+    def next_us(self):
+        """Interval in microseconds before the next step, or 0 when finished."""
+        if self.remaining <= 0:
+            return 0
+        v = min(self._v_at(self.done + 1), self._v_at(self.remaining))
+        self.done += 1
+        self.remaining -= 1
+        return int(1000000 / v)
+
+    def retarget(self, steps_left):
+        """Change how many steps are still to go. Steps already issued and the
+        ramp-up so far are kept."""
+        self.remaining = max(0, int(steps_left))
+
+
+def intervals(steps, v_max, accel, v_start=0, shape=TRAPEZOID):
+    """List of step intervals (us) for a whole move."""
+    p = Profile(steps, v_max, accel, v_start, shape)
+    out = []
+    us = p.next_us()
+    while us:
+        out.append(us)
+        us = p.next_us()
+    return out
+
+
+def move_time_us(steps, v_max, accel, v_start=0, shape=TRAPEZOID):
+    return sum(intervals(steps, v_max, accel, v_start, shape))
+
+
+if __name__ == "__main__":
+    import sys
+    args = [float(a) for a in sys.argv[1:4]]
+    steps, v_max, accel = (args + [400, 3000, 15000][len(args):])
+    for name, shape in (("trapezoid", TRAPEZOID), ("s-curve", SCURVE)):
+        iv = intervals(int(steps), v_max, accel, 0, shape)
+        print("%-9s %d steps in %.1f ms, fastest %d us, first %d us" %
+              (name, len(iv), sum(iv) / 1000, min(iv), iv[0]))
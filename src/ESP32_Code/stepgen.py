@@ -0,0 +1,226 @@
+# Hardware-timed STEP/DIR pulse generator for the ESP32.
+#
+# Pulse trains are clocked out by the RMT peripheral, so step timing does not
+# depend on the Python loop, BLE interrupts or GC. Moves are planned by
+# step_profile.Profile and sent to the RMT in chunks; a machine.Timer
+# callback hands over the next chunk as soon as the current one has drained
+# (never blocking in write_pulses), so the CPU is free for the whole move. Boards without esp32.RMT fall back to a
+# one-shot machine.Timer per step (soft IRQ, so expect some jitter).
+#
+# Upload step_profile.py next to this file.
+#
+#   stepper = StepGen(STEP_PIN_NUM, DIR_PIN_NUM, v_max=3000, accel=15000)
+#   stepper.move(-400)          # returns immediately
+#   stepper.wait()              # or poll stepper.busy() / set stepper.on_done
+
+from machine import Pin, Timer
+import time
+from step_profile import Profile, TRAPEZOID, SCURVE
+
+try:
+    import esp32
+except ImportError:
+    esp32 = None
+
+PULSE_HIGH_US = 5       # STEP high time; drivers need >= 2.5 us
+CHUNK_STEPS = 64        # steps per RMT write (default; see chunk_steps)
+FEED_MS = 1             # feeder timer period
+FEED_LEAD_US = 3000     # with this little left, aim a one-shot at the end of the chunk
+FEED_MIN_US = 100       # shortest one-shot re-check while the RMT drains
+
+
+class StepGen(object):
+
+    def __init__(self, step_pin_num, dir_pin_num, v_max=2000, accel=10000, v_start=400,
+                 shape=TRAPEZOID, dir_invert=False, rmt_channel=0, timer_id=0,
+                 chunk_steps=CHUNK_STEPS):
+        """chunk_steps: steps per RMT write. Up to two chunks are committed
+        ahead of the shaft and out of reach of retarget(), so callers that
+        retarget keep it small."""
+        self.v_max = v_max
+        self.accel = accel
+        self.v_start = v_start
+        self.shape = shape
+        self.position = 0       # steps issued, signed; stop() takes back the unsent ones
+        self.on_done = None     # called (from the timer callback) when a move ends
+        self._dir_invert = dir_invert
+        self._dir_pin = Pin(dir_pin_num, Pin.OUT, value=0)
+        self._step_pin_num = step_pin_num
+        self._timer = Timer(timer_id)
+        self._profile = None
+        self._sign = 1
+        self._busy = False
+        # Two duration buffers: one in flight, one being prepared.
+        self._chunk = chunk_steps
+        self._cur = [0] * (2 * chunk_steps)
+        self._next = [0] * (2 * chunk_steps)
+        self._cur_n = 0
+        self._next_n = 0
+        self._cur_start = 0
+        self._cur_us = 0
+        if esp32 is not None and hasattr(esp32, 'RMT'):
+            self._rmt = self._new_rmt(rmt_channel)
+            self._rmt_channel = rmt_channel
+        else:
+            self._rmt = None
+            self._step_pin = Pin(step_pin_num, Pin.OUT, value=0)
+
+    def _new_rmt(self, channel):
+        # 80 MHz APB / 80 = 1 us ticks; the line idles low between writes.
+        return esp32.RMT(channel, pin=Pin(self._step_pin_num), clock_div=80)
+
+    # ---------- public API ----------
+
+    def move(self, steps, v_max=None, accel=None, shape=None):
+        """Start a relative move of `steps` (signed). Any move in progress is
+        stopped first. Returns immediately."""
+        if self._busy:
+            self.stop()
+        if steps == 0:
+            return
+        self._sign = 1 if steps > 0 else -1
+        self._dir_pin.value((steps > 0) ^ self._dir_invert)
+        self._profile = Profile(steps,
+                                self.v_max if v_max is None else v_max,
+                                self.accel if accel is None else accel,
+                                self.v_start,
+                                self.shape if shape is None else shape)
+        self._busy = True
+        if self._rmt is None:
+            self._tick(None)
+            return
+        self._next_n = self._fill(self._next)
+        self._cur_n = 0
+        self._send()
+        self._timer.init(mode=Timer.PERIODIC, period=FEED_MS, callback=self._feed)
+
+    def retarget(self, steps_left):
+        """Change the number of steps still to come in the running move. Steps
+        already planned into a chunk cannot be taken back, so the move is never
+        shorter than that."""
+        if self._profile is not None:
+            committed = self.remaining() - self._profile.remaining
+            self._profile.retarget(steps_left - committed)
+
+    def stop(self):
+        """Halt immediately and forget the rest of the move."""
+        self._timer.deinit()
+        if self._profile is None and not self._busy:
+            return
+        if self._rmt is not None and not self._rmt.wait_done():
+            # No abort in the RMT API: re-create the channel to cut the train.
+            sent = self._steps_elapsed()
+            self._rmt.deinit()
+            self._rmt = self._new_rmt(self._rmt_channel)
+            self.position -= self._sign * (self._cur_n - sent)
+        self._profile = None
+        self._next_n = 0
+        self._finish()
+
+    def busy(self):
+        return self._busy
+
+    def direction(self):
+        """Direction of the current (or last) move: 1 or -1."""
+        return self._sign
+
+    def remaining(self):
+        """Steps not yet clocked out, as far as the generator can tell."""
+        if not self._busy:
+            return 0
+        left = self._next_n + (self._profile.remaining if self._profile else 0)
+        if self._rmt is not None:
+            left += self._cur_n - self._steps_elapsed()
+        return left
+
+    def wait(self, timeout_ms=0):
+        """Block until the move is finished. Returns False on timeout."""
+        t0 = time.ticks_ms()
+        while self._busy:
+            if timeout_ms and time.ticks_diff(time.ticks_ms(), t0) > timeout_ms:
+                return False
+            time.sleep_ms(1)
+        return True
+
+    # ---------- RMT backend ----------
+
+    def _fill(self, buf):
+        """Plan up to one chunk of steps into buf as (high, low) durations."""
+        p = self._profile
+        n = 0
+        while n < self._chunk:
+            us = p.next_us()
+            if not us:
+                break
+            buf[2 * n] = PULSE_HIGH_US
+            # RMT durations are 15-bit; slower than ~30 steps/s is clipped.
+            buf[2 * n + 1] = min(us - PULSE_HIGH_US, 32767)
+            n += 1
+        return n
+
+    def _send(self):
+        """Hand the prepared chunk to the (idle) RMT, then plan the next."""
+        n = self._next_n
+        if n == self._chunk:
+            self._rmt.write_pulses(self._next, 1)
+        else:
+            self._rmt.write_pulses(self._next[:2 * n], 1)
+        self._cur_start = time.ticks_us()
+        self._cur, self._next = self._next, self._cur
+        self._cur_n = n
+        self._cur_us = 0
+        for i in range(2 * n):
+            self._cur_us += self._cur[i]
+        self.position += self._sign * n
+        self._next_n = self._fill(self._next)
+
+    def _steps_elapsed(self):
+        """Steps of the in-flight chunk already on the wire."""
+        t = time.ticks_diff(time.ticks_us(), self._cur_start)
+        buf = self._cur
+        acc = 0
+        for i in range(self._cur_n):
+            acc += buf[2 * i] + buf[2 * i + 1]
+            if acc > t:
+                return i
+        return self._cur_n
+
+    def _feed(self, _timer):
+        if not self._busy:
+            return
+        if not self._rmt.wait_done():
+            # Still clocking out: write_pulses() would block in this callback
+            # until it drains. Near the end, come back when it should be done
+            # instead of on the next FEED_MS tick.
+            left = self._cur_us - time.ticks_diff(time.ticks_us(), self._cur_start)
+            if self._next_n and left < FEED_LEAD_US:
+                self._timer.init(mode=Timer.ONE_SHOT, freq=1000000 / max(left, FEED_MIN_US),
+                                 callback=self._feed)
+            return
+        if self._next_n:
+            self._send()
+            self._timer.init(mode=Timer.PERIODIC, period=FEED_MS, callback=self._feed)
+        else:
+            self._timer.deinit()
+            self._profile = None
+            self._finish()
+
+    # ---------- Timer fallback ----------
+
+    def _tick(self, _timer):
+        us = self._profile.next_us() if self._profile is not None else 0
+        if not us:
+            self._profile = None
+            self._finish()
+            return
+        self._step_pin.value(1)
+        time.sleep_us(PULSE_HIGH_US)
+        self._step_pin.value(0)
+        self.position += self._sign
+        self._timer.init(mode=Timer.ONE_SHOT, freq=1000000 / us, callback=self._tick)
+
+    def _finish(self):
+        was_busy = self._busy
+        self._busy = False
+        if was_busy and self.on_done is not None:
+            self.on_done()
@@ -41,6 +41,19 @@ def validate_commands(lines):
         
     return valid_pairs
 
+def restrike_fingers(commands, i):
+    """Fingers of command i that command i+1 strikes again without moving,
+    so the ESP32 can lift just those to hover height. Empty if none."""
+    if i + 1 >= len(commands):
+        return []
+    move_next, play_next = commands[i + 1]
+    notes = move_next.split(",")
+    if notes[0].strip().upper() != notes[1].strip().upper():
+        return []
+    fingers_now = {chord.split(",")[0].strip() for chord in commands[i][1].split(";")}
+    fingers_next = {chord.split(",")[0].strip() for chord in play_next.split(";")}
+    return sorted(fingers_now & fingers_next)
+
 async def main():
     print("Scanning for ESP32-BLE-Control...")
     device = await BleakScanner.find_device_by_name("ESP32-BLE-Control")
@@ -71,9 +84,12 @@ async def main():
         while True:
             print("Starting playback...\n")
             
-            for move_cmd, play_cmd in commands:
+            for i, (move_cmd, play_cmd) in enumerate(commands):
                 # Combine into a single payload separated by "|"
                 packet = f"{move_cmd}|{play_cmd}"
+                restrike = restrike_fingers(commands, i)
+                if restrike:
+                    packet += "|H" + ";".join(restrike)
                 
                 print(f"Sending: {packet}")
                 await client.write_gatt_char(CHAR_UUID, packet.encode("utf-8"))